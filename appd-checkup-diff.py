@@ -0,0 +1,161 @@
+# Compares two appd-checkup.py reports (CSV, JSON Lines or Parquet) and lists what changed between them - nodes that
+# appeared or disappeared, stopped or started reporting, or changed agent version or machine.
+# usage: python appd-checkup-diff.py <older report> <newer report> [--output changes.csv]
+# for questions / help contact Robert Vandervoort - rvander2@cisco.com
+# CHEERS!
+
+import os
+import sys
+import json
+import argparse
+import csv
+import datetime
+
+#--- CONFIGURATION SECTION ---
+# Categories in the order they are reported, with the heading printed for each
+CATEGORIES = {
+    "appeared": "Nodes that appeared",
+    "disappeared": "Nodes that disappeared",
+    "stopped_reporting": "Nodes that stopped reporting",
+    "started_reporting": "Nodes that started reporting",
+    "agent_version_changed": "Nodes whose agent version changed",
+    "machine_changed": "Nodes that moved machine or OS",
+}
+
+# A node whose Last up is more than STALE_MINS older than its report's run time counts as not reporting, even though
+# its Last up is still a date - the checkup keeps showing the last time a node was seen for as long as that is within
+# its METRIC_DURATION_MINS. The run time of a report is taken as the latest Last up in it. Can also be set with
+# --stale-mins.
+STALE_MINS = 60
+
+# How many nodes to list under each category on the console, the output file always gets all of them. 0 lists them all.
+MAX_LISTED = 20
+
+#---FUNCTION DEFINITIONS
+def read_report(path):
+    """yields each row of a checkup report as a dict keyed by column, whatever format it was written in"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".jsonl":
+        with open(path) as report:
+            for line in report:
+                if line.strip():
+                    yield json.loads(line)
+    elif extension == ".parquet":
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            print("Reading Parquet reports needs the pyarrow package - pip install pyarrow")
+            sys.exit(1)
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches():
+            yield from batch.to_pylist()
+    else:
+        with open(path, newline='') as report:
+            yield from csv.DictReader(report)
+
+def last_up(value):
+    """the Last up column as a datetime, or None when it holds a message such as METRIC DATA NOT FOUND IN TIME RANGE"""
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+def load_snapshot(path):
+    """indexes the node rows of a report on (application, tier, node). Tier availability rows and the placeholder rows
+    for applications and tiers without nodes are skipped. Returns the index and the report's run time, the latest
+    Last up in it, or None when no node was seen"""
+    snapshot = {}
+    run_time = None
+    for row in read_report(path):
+        if not row["agenttype"] or row["Node"] in ("-", None, ""):
+            continue
+        snapshot[(row["Application"], row["Tier"], row["Node"])] = (
+            row["Last up"], row["agenttype"], row["machineAgentVersion"] or "", row["appAgentVersion"] or "", row["machineName"] or "", row["OS"] or ""
+        )
+        seen = last_up(row["Last up"])
+        if seen is not None and (run_time is None or seen > run_time):
+            run_time = seen
+    return snapshot, run_time
+
+def reporting(seen, run_time):
+    """whether a node last seen at seen was still reporting when its report ran"""
+    return seen is not None and seen >= run_time - datetime.timedelta(minutes=STALE_MINS)
+
+def diff_snapshots(old, new, old_run_time, new_run_time):
+    """sorts every node into the categories it falls in, in one pass over the newer snapshot - anything left in the
+    older one afterwards has disappeared. old is emptied as it goes. A node stopped reporting if it was reporting in
+    the older report and, in the newer one, it has no Last up, its Last up is stale or its Last up did not move on"""
+    changes = {category: [] for category in CATEGORIES}
+
+    for key, (new_last_up, _, new_machine_agent, new_app_agent, new_machine, new_os) in new.items():
+        previous = old.pop(key, None)
+        if previous is None:
+            changes["appeared"].append((key, "", new_last_up))
+            continue
+        old_last_up, _, old_machine_agent, old_app_agent, old_machine, old_os = previous
+
+        old_seen, new_seen = last_up(old_last_up), last_up(new_last_up)
+        was_reporting = reporting(old_seen, old_run_time)
+        is_reporting = reporting(new_seen, new_run_time)
+        if is_reporting and was_reporting and new_run_time > old_run_time and new_seen <= old_seen:
+            is_reporting = False
+        if was_reporting and not is_reporting:
+            changes["stopped_reporting"].append((key, old_last_up, new_last_up))
+        elif is_reporting and not was_reporting:
+            changes["started_reporting"].append((key, old_last_up, new_last_up))
+
+        if (old_machine_agent, old_app_agent) != (new_machine_agent, new_app_agent):
+            old_version = " / ".join(version for version in (old_machine_agent, old_app_agent) if version)
+            new_version = " / ".join(version for version in (new_machine_agent, new_app_agent) if version)
+            changes["agent_version_changed"].append((key, old_version, new_version))
+
+        if (old_machine, old_os) != (new_machine, new_os):
+            changes["machine_changed"].append((key, f"{old_machine} {old_os}".strip(), f"{new_machine} {new_os}".strip()))
+
+    changes["disappeared"] = [(key, previous[0], "") for key, previous in old.items()]
+    return changes
+
+def print_changes(changes, old_count, new_count):
+    """prints a summary of the changes followed by the nodes in each category"""
+    print(f"{old_count} nodes before, {new_count} nodes after")
+    for category, heading in CATEGORIES.items():
+        print(f"    {heading}: {len(changes[category])}")
+
+    for category, heading in CATEGORIES.items():
+        if not changes[category]:
+            continue
+        print(f"\n--- {heading}")
+        listed = changes[category] if not MAX_LISTED else changes[category][:MAX_LISTED]
+        for (application, tier, node), before, after in listed:
+            print(f"    {application} / {tier} / {node}: {before or '-'} -> {after or '-'}")
+        if len(listed) < len(changes[category]):
+            print(f"    ... and {len(changes[category]) - len(listed)} more")
+
+def write_changes(changes, path):
+    """writes every change to a CSV file, one row per node and category"""
+    with open(path, "w", newline='') as output:
+        csv_writer = csv.writer(output)
+        csv_writer.writerow(["Change", "Application", "Tier", "Node", "Before", "After"])
+        for category in CATEGORIES:
+            for (application, tier, node), before, after in changes[category]:
+                csv_writer.writerow([category, application, tier, node, before, after])
+
+#--- MAIN
+# run through appd, __prog__ is the command it was run as, e.g. "appd apps"
+parser = argparse.ArgumentParser(prog=globals().get("__prog__"), description="Lists what changed between two appd-checkup.py reports.")
+parser.add_argument("old", help="the older report")
+parser.add_argument("new", help="the newer report")
+parser.add_argument("--output", help="also write every change to this CSV file")
+parser.add_argument("--stale-mins", type=int, default=STALE_MINS, help="minutes without reporting, before its report ran, after which a node counts as not reporting (default: %(default)s)")
+args = parser.parse_args()
+STALE_MINS = args.stale_mins
+
+old_snapshot, old_run_time = load_snapshot(args.old)
+new_snapshot, new_run_time = load_snapshot(args.new)
+old_count, new_count = len(old_snapshot), len(new_snapshot)
+
+changes = diff_snapshots(old_snapshot, new_snapshot, old_run_time, new_run_time)
+print_changes(changes, old_count, new_count)
+
+if args.output:
+    write_changes(changes, args.output)
+    print(f"\nChanges written to {args.output}")
@@ -5,13 +5,24 @@
 # for questions / help contact Robert Vandervoort - rvander2@cisco.com
 # CHEERS!
 
+import os
 import sys
 import json
-import csv
+import contextlib
+import argparse
 import datetime
 import time
+import hashlib
+import threading
+import logging
 import urllib.parse
+import collections
+import concurrent.futures
+import queue
 import requests
+# the login, session, rate limiting, retries, statistics, logging, parsers and exporters shared with appd-servers-checkup.py
+import appd_core
+from appd_core import log, Application, Tier, Node, BusinessTransaction, HealthRule, Server, EXPORTERS, InventoryStore, Progress, setup_logging, handle_rest_errors, controller_get, validate_json, iter_response_chunks, iter_json_array, iter_xml_elements, print_request_stats, write_request_stats, __request_timing__
 
 #--- CONFIGURATION SECTION ---
 
@@ -19,6 +30,12 @@ import requests
 # will flood the console when running against a decent sized controller.
 DEBUG = False
 
+# Console messages - "DEBUG", "INFO", "WARNING" or "ERROR". INFO shows a progress line with the rate and time left every
+# PROGRESS_INTERVAL_SECS seconds, DEBUG adds a line for every query. Can also be set with --log-level, and --log-file
+# writes the messages, INFO and up or everything at DEBUG, to a file with timestamps and thread names.
+LOG_LEVEL = "DEBUG" if DEBUG else "INFO"
+PROGRESS_INTERVAL_SECS = 10
+
 #Replace with your AppDynamics API client details
 APPDYNAMICS_ACCOUNT_NAME = "customer1"
 APPDYNAMICS_API_CLIENT = "your-api-client-name"
@@ -27,6 +44,13 @@ APPDYNAMICS_API_CLIENT_SECRET = "your-super-secret-key-12342134"
 #For reporting on a single application use the ID from the query seen in the URL in AppD,
 application_id = "" # leave this as is and do not comment it out
 
+# What to report on - "nodes" lists every application, tier and node with when it was last seen, "healthrules" lists
+# every health rule of every application with what it affects and its critical and warning conditions, "bts" lists
+# every business transaction with its tier and entry point type, and "snapshots" counts the request snapshots of each
+# business transaction, tier and error state (see SNAPSHOT_DURATION_MINS). The report name goes in the default output
+# file name in place of "checkup". Can also be set with --report.
+REPORT = "nodes"
+
 # Now off by default - setting this to True will write a row in the output CSV representing the number of app nodes seen on a tier and the last time that tier availability was seen. 
 # Initially this was useful ro help create this script but now it kind of just confuses the data so we are not grabbing it by default.
 WRITE_TIER_AVAILABILITY_DATA = False
@@ -35,6 +59,31 @@ WRITE_TIER_AVAILABILITY_DATA = False
 #OUTPUT_CSV_FILE = "output.csv"
 OUTPUT_CSV_FILE = APPDYNAMICS_ACCOUNT_NAME+"_checkup_"+datetime.date.today().strftime("%m-%d-%Y")+".csv"
 
+# Output format - "csv", "jsonl" (a JSON object per line) or "parquet" (needs pyarrow - pip install pyarrow). JSON Lines
+# and Parquet keep lists and dicts as real nested values rather than their text, and Parquet loads far quicker into
+# analysis tools. The extension of the output file follows the format. Can also be set with --format.
+OUTPUT_FORMAT = "csv"
+
+# Optionally keep the inventory of every run in a SQLite database as well (or run with --db <file>), to query it across
+# runs - which nodes went dark since last week, how agent versions drifted over the last 90 days and so on. Each run is
+# added to the runs table, and its rows go in a table of their own with the run's id. Leave empty to skip it.
+INVENTORY_DB = ""
+
+# Progress is checkpointed to this file as each tier is written to the CSV. If a run is interrupted, run the script
+# again with --resume to skip the tiers that were already written and append only the missing rows.
+CHECKPOINT_FILE = OUTPUT_CSV_FILE + ".checkpoint"
+
+"""
+Incremental mode - set INCREMENTAL to True or run with --incremental. Each run saves the last time every node was seen
+to INCREMENTAL_STATE_FILE. The next run only looks back as far as the previous run, plus INCREMENTAL_OVERLAP_MINS to
+be safe, so a daily run queries a day of data instead of METRIC_DURATION_MINS worth. Nodes that do not show up in that
+short window keep the last seen time saved by the previous run. Only nodes the previous run knew nothing about (new
+nodes, or nodes it never saw report) are looked up over the full METRIC_DURATION_MINS.
+"""
+INCREMENTAL = False
+INCREMENTAL_STATE_FILE = APPDYNAMICS_ACCOUNT_NAME + "_last_seen.json"
+INCREMENTAL_OVERLAP_MINS = 60
+
 # Set the base URL for the AppDynamics REST API
 # --- replace this with your on-prem controller URL if you're on prem
 BASE_URL = "https://"+APPDYNAMICS_ACCOUNT_NAME+".saas.appdynamics.com"
@@ -56,6 +105,36 @@ METRIC_DURATION_MINS = 43800 #1 month
 #METRIC_DURATION_MINS = 240 #4 hours
 #METRIC_DURATION_MINS = 5 #5 mins
 
+"""
+Tiered look back - rather than asking for METRIC_DURATION_MINS of data for every node, start with the first window in
+LOOKBACK_WINDOWS_MINS and only widen it, one step at a time, for the nodes that did not report in the smaller window.
+Healthy nodes are found with a tiny, cheap query and only the nodes that are down pay for the long one. The last step
+is always METRIC_DURATION_MINS so the result is the same as asking for it straight away, which is what setting
+TIERED_LOOKBACK to False does. With this on it is reasonable to set METRIC_DURATION_MINS to 12 months or more.
+"""
+TIERED_LOOKBACK = True
+LOOKBACK_WINDOWS_MINS = [60, 1440, 43800, 569400] #1 hour, 1 day, 1 month, 13 months
+
+"""
+Tier short circuit - the tier availability metric counts the app agents of the tier that reported in each minute. When
+its latest data point counts every app agent node registered in the tier, they all reported in that minute and that is
+their last seen time, so they need no query of their own. Only degraded tiers, and machine agent nodes which the tier
+metric does not count, are looked up node by node. On a mostly healthy controller this skips most node queries. The
+tier is checked over the last TIER_SHORT_CIRCUIT_MINS minutes, keep it at 4 hours or less to get one minute data points.
+Can also be turned on with --tier-short-circuit.
+"""
+TIER_SHORT_CIRCUIT = False
+TIER_SHORT_CIRCUIT_MINS = 60
+
+"""
+Join the servers - also fetch every machine known to Server Visibility, the list appd-servers-checkup.py reports on,
+and add the server each node runs on to the node's row: its host id, container image, namespace and pod, and the
+version of its machine agent. A node is matched to the server whose host id, name or pod name is the node's machine
+name, ignoring case. The servers are indexed on all three as their list downloads, alongside the crawl of the tiers,
+so joining costs one lookup per node. Can also be turned on with --join-servers.
+"""
+JOIN_SERVERS = False
+
 """
 Also, metric rollups may be considered when using broader time ranges, however the last up date will represent 
 the earliest data point in the series instead of the actual last time it reported in. see the doc:
@@ -63,120 +142,167 @@ https://docs.appdynamics.com/appd/24.x/latest/en/extend-appdynamics/appdynamics-
 """
 METRIC_ROLLUP = "false"
 
-#manages token expiration - do not change these values
-last_token_fetch_time = ""
-token_expiration = 300
-expiration_buffer = 30
+"""
+Number of worker threads used to crawl the controller. Leaving this at 1 queries one tier and one node at a time
+like earlier versions of this script did. Raising it fans the tier, node and availability lookups out across a pool
+of threads, which makes a big difference on controllers with thousands of nodes. Rows are still written to the CSV
+grouped by application and tier in the same order a sequential run would write them. Be kind to your controller,
+10-20 workers is plenty for most SaaS controllers. Can also be set with --workers.
+"""
+CONCURRENT_WORKERS = 1
 
-#---FUNCTION DEFINITIONS
-def authenticate(state):
-    """get XCSRF token for use in this session"""
-    if state == "reauth":
-        print("Obtaining a freah authentication token.")
-    if state == "initial":
-        print("Begin login.")
-    
-    connect(APPDYNAMICS_ACCOUNT_NAME, APPDYNAMICS_API_CLIENT, APPDYNAMICS_API_CLIENT_SECRET)
-    
-    return
+"""
+The snapshots report counts the request snapshots taken over the last SNAPSHOT_DURATION_MINS. Rather than asking for
+all of them in one request, the window is cut into slices of SNAPSHOT_SLICE_MINS that are fetched in parallel, each
+capped at SNAPSHOT_SLICE_MAX_RESULTS snapshots and counted as it streams in, so nothing but the counts is kept. A slice
+that comes back full, or takes longer than SNAPSHOT_SLICE_TIMEOUT_SECS between reads, is split in two and fetched
+again, down to slices of SNAPSHOT_MIN_SLICE_MINS. Past that a full slice is counted as it is and a failed one is left
+out, and both are reported.
+"""
+SNAPSHOT_DURATION_MINS = 1440 #1 day
+SNAPSHOT_SLICE_MINS = 60
+SNAPSHOT_SLICE_MAX_RESULTS = 5000
+SNAPSHOT_MIN_SLICE_MINS = 1
+SNAPSHOT_SLICE_TIMEOUT_SECS = 120
 
-def is_token_valid():
-    """Checks if the access token is valid and not expired."""
-    if DEBUG:
-        print("Checking token validity...")
+"""
+How node availability is queried. "tier" asks the controller once per tier for every node's availability using a
+wildcard metric path, "application" asks once per application for every node in every tier, and "node" goes back
+to one query per node. "tier" is a good default, "application" makes the fewest calls but each response is bigger.
+If a batched query fails the nodes it covered are queried one at a time instead. When the tiered look back widens its
+window it asks about the whole tier again in one query, unless fewer than NODE_BATCH_MIN_NODES nodes are left to
+find - those few are cheaper to query one at a time than to pull every node's series over the wider window.
+"""
+NODE_AVAILABILITY_BATCH = "tier"
+NODE_BATCH_MIN_NODES = 3
 
-    if __session__ is None:
+"""
+Every call to the controller goes through one shared HTTP session that keeps its connections open and reuses them,
+so we only pay for the TCP and TLS handshakes once per connection instead of once per request. HTTP_POOL_SIZE is the
+number of connections kept open - there is no point having it lower than the number of requests in flight.
+Set HTTP2 to True to talk HTTP/2 to the controller, this needs the httpx package with its http2 extra installed
+(pip install "httpx[http2]"). If httpx is missing we fall back to HTTP/1.1 with keep-alive.
+"""
+HTTP_POOL_SIZE = CONCURRENT_WORKERS * 2
+HTTP2 = False
+
+"""
+Controller API rate limiting. MAX_REQUESTS_PER_SECOND caps how fast requests are sent (0 turns the cap off) and
+MAX_IN_FLIGHT_REQUESTS caps how many can be outstanding at once. If the controller throttles us with a 429 the rate
+is halved, then it creeps back up towards MAX_REQUESTS_PER_SECOND while requests succeed, so we settle at whatever
+the controller can take. Throttled (429), overloaded (500, 502, 503, 504) and dropped requests are retried up to
+MAX_RETRIES times. We wait RETRY_BACKOFF_SECS before the first retry and double that each time, capped at
+RETRY_BACKOFF_MAX_SECS, with random jitter so parallel workers do not retry in lock step. If the controller sends a
+Retry-After header we wait as long as it asks instead.
+"""
+MAX_REQUESTS_PER_SECOND = 50
+MAX_IN_FLIGHT_REQUESTS = 20
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECS = 1
+RETRY_BACKOFF_MAX_SECS = 60
+
+"""
+Applications, tiers and nodes change slowly, so their responses are cached on disk in CACHE_DIR and reused until they
+are older than the time to live for their endpoint (CACHE_TTL_SECS, in seconds). Once a cached response expires it is
+revalidated with the controller using its ETag / Last-Modified headers where the controller sent them, so a list that
+has not changed costs a quick 304 instead of the whole body. The oldest entries are dropped once the cache grows past
+CACHE_MAX_MB. Availability metrics are never cached. Set USE_CACHE to False (or run with --no-cache) to skip the cache,
+or REFRESH_CACHE to True (or run with --refresh) to ignore what is cached and fetch everything again.
+"""
+CACHE_DIR = ".appd_cache"
+CACHE_TTL_SECS = {"applications": 86400, "tiers": 86400, "nodes": 3600}
+CACHE_MAX_MB = 100
+USE_CACHE = True
+REFRESH_CACHE = False
+
+#progress - do not change these values
+__progress__ = None
+# nodes matched, and not matched, to a server when joining the servers
+__join_counts__ = collections.Counter()
+
+#---FUNCTION DEFINITIONS
+def cached_response(url, body):
+    """wraps a body from the cache up as a response so it is handled exactly like one fresh from the controller"""
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.encoding = "utf-8"
+    response._content = body
+    return response
+
+def read_cache_entry(path):
+    """returns the metadata and body of a cache entry, or None, None if there is not a usable one"""
+    try:
+        with open(path, "rb") as entry:
+            meta = json.loads(entry.readline())
+            return meta, entry.read()
+    except (OSError, ValueError):
+        return None, None
+
+def write_cache_entry(path, meta, body):
+    """writes a cache entry - metadata on the first line, then the body - replacing any older copy in one go"""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(temp_path, "wb") as entry:
+        entry.write(json.dumps(meta).encode() + b"\n")
+        entry.write(body)
+    os.replace(temp_path, path)
+
+def cached_get(url, endpoint):
+    """GETs an inventory URL through the on-disk cache, going to the controller only when the cached copy is missing,
+    expired or being refreshed"""
+    if not USE_CACHE:
+        return controller_get(url)
+
+    path = os.path.join(CACHE_DIR, hashlib.sha256(url.encode()).hexdigest())
+    meta, body = (None, None) if REFRESH_CACHE else read_cache_entry(path)
+
+    if meta and time.time() - meta["fetched"] < CACHE_TTL_SECS.get(endpoint, 0):
         if DEBUG:
-            print("__session__ not found or empty.")
-        return False
+            log.debug(f"        --- cache hit for {url}")
+        os.utime(path)
+        __request_timing__.cached = True
+        return cached_response(url, body)
 
-    # Conservative buffer (e.g., 30 seconds before expiration)
-    if DEBUG:
-        print(f"__session__: {__session__}")
-    return time.time() < (token_expiration + last_token_fetch_time - expiration_buffer)
-
-def connect(account, apiclient, secret):
-    """Connects to the AppDynamics API and retrieves an OAuth token."""
-    global __session__, last_token_fetch_time, token_expiration
-    __session__ = requests.Session()
-
-    url = f"{BASE_URL}/controller/api/oauth/access_token?grant_type=client_credentials&client_id={apiclient}@{account}&client_secret={secret}"
-    payload = {} 
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-
-    print(f"Logging into the controller at: {BASE_URL}")
-
-    @handle_rest_errors  # Apply the error handling decorator
-    def make_auth_request():
-        response = __session__.request(
-            "POST",
-            url,
-            headers=headers,
-            data=payload,
-            verify=VERIFY_SSL
-        )
-        return response
-
-    auth_response, status = make_auth_request()
-    if DEBUG:
-        print(f"Authentication response:{auth_response} = {status}")
-
-    # Assuming auth_response isn't None if no errors occurred
-    if status == "valid":
-        if auth_response:
-            json_response = auth_response.json()
-            last_token_fetch_time = time.time()
-            token_expiration = json_response['expires_in']
-    else:
-        print(f"Unable to log in at: {BASE_URL}")
-        print("Please check your controller URL and try again.")
-        sys.exit(9)
+    headers = {}
+    if meta and meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta and meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
 
-    __session__.headers['X-CSRF-TOKEN'] = json_response['access_token']
-    __session__.headers['Authorization'] = f'Bearer {json_response["access_token"]}'
-    
-    print("Authenticated with controller.")
-    
-    if DEBUG:
-        print(f"Last token fetch time: {last_token_fetch_time}")
-        print(f"Token expires in: {json_response['expires_in']}")
-        print(f"Session headers: {__session__.headers}")
-    
-    return True
-
-def handle_rest_errors(func):
-    """for handling REST calls"""
-    def inner_function(*args, **kwargs):
-        error_map = {
-            400: "Bad Request - The request was invalid.",
-            401: "Unauthorized - Authentication failed.",
-            403: "Forbidden - You don't have permission to access this resource.",
-            404: "Not Found - The resource could not be found.",
-            500: "Internal Server Error - Something went wrong on the server.",
-        }
+    response = controller_get(url, headers)
 
-        try:
-            response = func(*args, **kwargs)
-            response.raise_for_status()
-            return response, "valid"
-        except requests.exceptions.HTTPError as err:
-            error_code = err.response.status_code
-            error_explanation = error_map.get(error_code, "Unknown HTTP Error")
-            print(f"HTTP Error: {error_code} - {error_explanation}")
-            return error_explanation, "error"
-        except requests.exceptions.RequestException as err:
-            if isinstance(err, requests.exceptions.ConnectionError):
-                print("Connection Error: Failed to establish a new connection.")
-                return err, "error"
-            else: 
-                print(f"Request Exception: {err}") 
-                return err, "error"
-        except Exception:  
-            error_type, error_value, _ = sys.exc_info() 
-            print(f"Unexpected Error: {error_type.__name__}: {error_value}")
-            return error_value, "error"
-
-    return inner_function
+    if response.status_code == 304 and meta:
+        if DEBUG:
+            log.debug(f"        --- cached copy of {url} is still current")
+        meta["fetched"] = time.time()
+        write_cache_entry(path, meta, body)
+        __request_timing__.revalidated = True
+        return cached_response(url, body)
+
+    if response.status_code == 200:
+        write_cache_entry(path, {
+            "url": url,
+            "fetched": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified")
+        }, response.content)
+
+    return response
+
+def trim_cache():
+    """drops the least recently used cache entries until the cache fits in CACHE_MAX_MB"""
+    if not USE_CACHE or not os.path.isdir(CACHE_DIR):
+        return
+
+    entries = [entry for entry in os.scandir(CACHE_DIR) if entry.is_file()]
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    cache_size = sum(entry.stat().st_size for entry in entries)
+
+    while entries and cache_size > CACHE_MAX_MB * 1024 * 1024:
+        entry = entries.pop(0)
+        cache_size -= entry.stat().st_size
+        os.remove(entry.path)
 
 def urlencode_string(text):
     """make app, tier or node names URL compatible for the REST call"""
@@ -190,73 +316,75 @@ def urlencode_string(text):
     return encoded_text
 
 @handle_rest_errors
-def get_metric(object_type, app, tier, agenttype, node):
-    """fetches last known agent availability info from tier or node level."""
+def get_metric(object_type, app, tier, agenttype, node, duration_mins=None):
+    """fetches last known agent availability info from tier or node level, looking back duration_mins minutes
+    (METRIC_DURATION_MINS unless told otherwise)."""
     tier = urlencode_string(tier)
     app = urlencode_string(app)
     if DEBUG:
-        print(f"        --- Begin get_metric({object_type},{app},{tier},{agenttype},{node})")
+        log.debug(f"        --- Begin get_metric({object_type},{app},{tier},{agenttype},{node})")
 
     if object_type == "node":
-        print("        --- Querying node availability.")
+        log.debug("        --- Querying node availability.")
         if agenttype == "MACHINE_AGENT":
             metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CIndividual%20Nodes%7C" + node + "%7CAgent%7CMachine%7CAvailability"
         else:
             metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CIndividual%20Nodes%7C" + node + "%7CAgent%7CApp%7CAvailability"
     
+    elif object_type == "nodes":
+        # wildcard query - one call returns a series for every node in the tier, or the whole app when tier is *
+        log.debug("        --- Querying availability for all nodes.")
+        metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CIndividual%20Nodes%7C*%7CAgent%7C*%7CAvailability"
+
     elif object_type == "tier":
-        print("        --- Querying tier availability.")
+        log.debug("        --- Querying tier availability.")
         metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CAgent%7CApp%7CAvailability"
         
     # If the machine agents were assigned a tier, the tier reads as an app agent. The availability data would be here instead
     # metric_path = "Application%20Infrastructure%20Performance%7C" + tier_name + "%7CAgent%7CMachine%7CAvailability"
     # future enhancement will reflect the number and last seen for machine agent tiers.
 
-    metric_url = BASE_URL + "/controller/rest/applications/" + app + "/metric-data?metric-path=" + metric_path + "&time-range-type=BEFORE_NOW&duration-in-mins=" + str(METRIC_DURATION_MINS) + "&rollup=" + METRIC_ROLLUP + "&output=json"
+    metric_url = BASE_URL + "/controller/rest/applications/" + app + "/metric-data?metric-path=" + metric_path + "&time-range-type=BEFORE_NOW&duration-in-mins=" + str(duration_mins or METRIC_DURATION_MINS) + "&rollup=" + METRIC_ROLLUP + "&output=json"
                                 
     #get metric data
     if DEBUG:
-        print("        --- metric url: " + metric_url)
+        log.debug("        --- metric url: " + metric_url)
 
-    metric_response = requests.get(
-        metric_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
+    metric_response = controller_get(metric_url)
 
     return metric_response
 
 def handle_metric_response(metric_data, metric_data_status):
     """Processes returned metric JSON data"""
     if DEBUG:
-        print("        --- handle_metric_response() - Handling metric data...")
-        print(f"        --- handle_metric_response() - metric_data: {metric_data}")
-        print(f"        --- handle_metric_response() - metric_data type: {type(metric_data)}")
-        print(f"        --- handle_metric_response() - metric_data_status: {metric_data_status}")
+        log.debug("        --- handle_metric_response() - Handling metric data...")
+        log.debug(f"        --- handle_metric_response() - metric_data: {metric_data}")
+        log.debug(f"        --- handle_metric_response() - metric_data type: {type(metric_data)}")
+        log.debug(f"        --- handle_metric_response() - metric_data_status: {metric_data_status}")
 
     if metric_data_status == "valid":
         if metric_data == []:
             dt = "METRIC DATA NOT FOUND IN TIME RANGE"
-            print(dt)
+            log.debug(dt)
             return dt, metric_data_status
-        if metric_data[-1]['metricName'] == "METRIC DATA NOT FOUND":
+        if metric_data[-1]['metricName'] == "METRIC DATA NOT FOUND" or not metric_data[-1]['metricValues']:
             dt = "METRIC DATA NOT FOUND IN TIME RANGE"
-            print(dt)
+            log.debug(dt)
             return dt, metric_data_status
         elif metric_data[-1]['metricValues'][-1]['startTimeInMillis']:
             if DEBUG:
-                print("        --- Performing datetime calculation on metric data")
+                log.debug("        --- Performing datetime calculation on metric data")
             last_start_time_millis = metric_data[-1]['metricValues'][-1]['startTimeInMillis']
             if DEBUG:
-                print(f"            --- startTimeInMillis: {last_start_time_millis}")
+                log.debug(f"            --- startTimeInMillis: {last_start_time_millis}")
             #convert EPOCH to human readable datetime - we have to divide by 1000 because we show EPOCH in ms not seconds
             if DEBUG:
-                print("            --- Converting EPOCH to datetime")
+                log.debug("            --- Converting EPOCH to datetime")
             epoch = (last_start_time_millis/1000)
             dt = datetime.datetime.fromtimestamp(epoch)
             value = metric_data[-1]['metricValues'][-1]['current']
             if DEBUG:
-                print(f"            --- dt: {dt} value: {value}")
+                log.debug(f"            --- dt: {dt} value: {value}")
             return dt, value
 
     elif metric_data_status == "empty":
@@ -271,220 +399,88 @@ def handle_metric_response(metric_data, metric_data_status):
         dt = "EMPTY RESPONSE"
         return dt, metric_data_status
 
-def validate_json(response):
-    """validation function to parse into JSON and catch empty sets returned from our API requests"""
-    if DEBUG:
-        print("        --- validate_json()")
-    if not response:
-        #this state is NOT always an error. Sometimes there are old tiers with no nodes anymore. Same for apps.
-        if DEBUG:
-            print("        ---- No response object was found.")
-        return [], "empty"
-
-    try:
-        if DEBUG:
-            print(f"        --- validate_json() - incoming response type:: {type(response)}")
-            print(f"        --- validate_json() - incoming response:{response}")
-        if not isinstance(response, requests.Response):
-            if DEBUG:
-                print(f"        --- validate_json() - length: {len(response)}") 
-                print("        --- validate_json() - unpacking response")
-            #unpack response
-            data, data_status = response
-            
-            #pass error and exceptions from the response along to the main code
-            if data_status == "error":
-                return data, data_status
-            else:
-                data = data.json()
-                if DEBUG:
-                    print(f"        --- validate_json() - data: {data} data_status: {data_status}")
-                return data, data_status
-        else:
-            # parse the request object into a json object and its status
-            json_data = response.json()
-
-            if DEBUG:
-                print(f"        --- validate_json() - data: {json_data}")
-                print(f"        --- validate_json() - json_data type: {type(json_data)}")  
-
-            # check for empty JSON object
-            if not json_data:
-                if DEBUG:
-                    print("\n            ---- The resulting JSON object judged as empty")
-                    print(f"            ---- data.text {data.text} , json_data {json_data}")
-                return None, "empty"
-
-            return json_data, "valid"
-
-    except json.JSONDecodeError:
-        # The data is not valid JSON.
-        if DEBUG:
-            print("The data is not valid JSON.")
-        return None, "error"
-
 @handle_rest_errors
 def get_applications():
     """Get a list of all applications"""
-    print("--- Fetching applications...")
+    log.info("--- Fetching applications...")
     
-    if not is_token_valid():
-        authenticate("reauth")
-
     if application_id:
         #chosen when user supplied an app id in the config
         applications_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "?output=json"
         if DEBUG:
-            print("--- from "+applications_url)
+            log.debug("--- from "+applications_url)
     else:
         applications_url = BASE_URL + "/controller/rest/applications?output=json"
         if DEBUG:
-            print("--- from "+applications_url)
+            log.debug("--- from "+applications_url)
     
-    applications_response = requests.get(
-        applications_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
+    applications_response = cached_get(applications_url, "applications")
 
     if DEBUG:
-        print(applications_response.text)
+        log.debug(applications_response.text)
     return applications_response
 
 @handle_rest_errors
 def get_tiers(application_id):
     """Gets the tiers in the application"""
-    if not is_token_valid():
-        authenticate("reauth")
-    
     tiers_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/tiers?output=json"
     
     if DEBUG:
-        print("    --- Fetching tiers from: "+ tiers_url)
-    else:
-        print("    --- Fetching tiers...")
+        log.debug("    --- Fetching tiers from: "+ tiers_url)
 
-    tiers_response = requests.get(
-        tiers_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
+    tiers_response = cached_get(tiers_url, "tiers")
     if DEBUG:
-        print(f"    --- get_tiers response: {tiers_response.text}")
+        log.debug(f"    --- get_tiers response: {tiers_response.text}")
 
     return tiers_response
 
 @handle_rest_errors
 def get_nodes(application_id, tier_id):
     """Gets the nodes in a tier"""
-    if not is_token_valid():
-        authenticate("reauth")
-
     nodes_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/tiers/" + str(tier_id) + "/nodes?output=json"
     if DEBUG:
-        print(f"        --- Fetching node data from {nodes_url}.")
-    else:
-        print("        --- Fetching nodes from tier.")
+        log.debug(f"        --- Fetching node data from {nodes_url}.")
 
-    nodes_response = requests.get(
-        nodes_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
+    nodes_response = cached_get(nodes_url, "nodes")
 
     return nodes_response
 
 @handle_rest_errors
-def get_snapshots(application_id):
-    if not is_token_valid():
-        authenticate("reauth")
-
-    snapshots_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/request-snapshots?time-range-type=BEFORE_NOW&duration-in-mins=" + str(METRIC_DURATION_MINS) + "&first-in-chain=true&maximum-results=1000000&output=json"
+def get_snapshots(application_id, start_millis, end_millis, maximum_results, timeout=None):
+    '''retrieves the first in chain request snapshots taken between two times, at most maximum_results of them'''
+    snapshots_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/request-snapshots?time-range-type=BETWEEN_TIMES&start-time=" + str(start_millis) + "&end-time=" + str(end_millis) + "&first-in-chain=true&maximum-results=" + str(maximum_results) + "&output=json"
 
     if DEBUG:
-        print("    --- Fetching snapshots from: "+ snapshots_url)
-    else:
-        print("    --- Fetching snapshots...")
+        log.debug("    --- Fetching snapshots from: "+ snapshots_url)
 
-    snapshots_response = requests.get(
-        snapshots_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-    #if DEBUG:
-    #    print(f"    --- get_snapshots response: {snapshots_response.text}")
+    # streamed - a busy application takes thousands of snapshots an hour, parse it with iter_json_array()
+    snapshots_response = controller_get(snapshots_url, stream=True, timeout=timeout)
 
     return snapshots_response
 
-#@handle_rest_errors
+@handle_rest_errors
 def get_bts(application_id): 
     '''retrieves business transactions list from the application'''
     
-    if not is_token_valid():
-        authenticate("reauth")
-
-    bts_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/business-transactions"
+    bts_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/business-transactions?output=json"
 
     if DEBUG:
-        print("    --- Fetching bts from: "+ bts_url)
-    else:
-        print("    --- Fetching bts...")
-
-    bts_response = requests.get(
-        bts_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-    #if DEBUG:
-    #    print(f"    --- get_bts response: {bts_response.text}")
+        log.debug("    --- Fetching bts from: "+ bts_url)
 
-    #convert the XML to JSON
-    xml_data = bts_response.text
+    # streamed - big applications have tens of thousands of BTs, parse it with iter_business_transactions()
+    bts_response = controller_get(bts_url, stream=True)
 
-    # Convert XML to an ordered dictionary
-    dict_data = xmltodict.parse(xml_data)
-    
-    #if DEBUG:
-    #    print("    --- BTs output:")
-    #    print(json.dumps(dict_data, indent=4)) 
-    
-    # Create the in-memory map
-    transaction_name_map = {}
-    
-    # Extract data and populate the map
-    for business_transaction in dict_data["business-transactions"]["business-transaction"]:
-        transaction_id = int(business_transaction["id"])  # Now 'id' is  accessed directly
-        transaction_name = business_transaction["name"]
-        entry_point_type = business_transaction.get("entryPointType")
-        tier_name = business_transaction.get("tierName")
-
-        transaction_name_map[transaction_id] = {
-            "name": transaction_name,
-            "entryPointType": entry_point_type,
-            "tierName": tier_name
-        }
-    
-    return transaction_name_map
+    return bts_response
 
 @handle_rest_errors
 def get_servers():
     '''Get a list of all servers'''
     servers_url = BASE_URL + "/controller/sim/v2/user/machines"
     if DEBUG:
-        print(f"    --- Retrieving Servers from {servers_url}")
-    else:
-        print("    --- Retrieving Servers...")
+        log.debug(f"    --- Retrieving Servers from {servers_url}")
               
-    servers_response = requests.get(
-        servers_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-
-    if DEBUG:
-        servers_data = servers_response.json()
-        servers_data_count = (len(servers_data))
-        print("servers_data length: " + str((servers_data_count)))
+    # streamed - the list can run to hundreds of MB on big container estates, parse it with iter_json_array()
+    servers_response = controller_get(servers_url, stream=True)
 
     return servers_response
 
@@ -492,138 +488,850 @@ def get_servers():
 def get_healthRules(application_id):
     '''retrieves health rules from application(s)'''
 
-    if not is_token_valid():
-        authenticate("reauth")
-
     healthRules_url = BASE_URL + "/controller/alerting/rest/v1/applications/" + str(application_id) + "/health-rules"
 
     if DEBUG:
-        print(f"    --- Fetching health rules from: {healthRules_url}")
-    else:
-        print("    --- Fetching health rules...")
+        log.debug(f"    --- Fetching health rules from: {healthRules_url}")
 
-    healthRules_response = requests.get(
-        healthRules_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
+    healthRules_response = controller_get(healthRules_url)
     if DEBUG:
-        print(f"    --- get_healthRules response: {healthRules_response.text}")
+        log.debug(f"    --- get_healthRules response: {healthRules_response.text}")
 
     return healthRules_response    
 
+@handle_rest_errors
+def get_healthRule(application_id, health_rule_id):
+    '''retrieves the full definition of a health rule - what it affects and its evaluation criteria'''
+
+    healthRule_url = BASE_URL + "/controller/alerting/rest/v1/applications/" + str(application_id) + "/health-rules/" + str(health_rule_id)
+
+    if DEBUG:
+        log.debug(f"        --- Fetching health rule from: {healthRule_url}")
+
+    return controller_get(healthRule_url)
+
+@contextlib.contextmanager
+def worker_pool(workers=None):
+    """a pool of workers threads, CONCURRENT_WORKERS by default, for crawling the controller. All the work is queued on it up front, so if
+    the run fails or is interrupted the work not started yet is dropped rather than waited for - otherwise the
+    controller would go on being crawled with nothing left to write the results"""
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers or CONCURRENT_WORKERS)
+    try:
+        yield pool
+    except BaseException:
+        pool.shutdown(wait=True, cancel_futures=True)
+        raise
+    pool.shutdown(wait=True)
+
+def completed(rows):
+    """wraps rows that are already known in a finished future so they can be queued with the pending tier work"""
+    future = concurrent.futures.Future()
+    future.set_result(rows)
+    return future
+
+def fetch_node_availability(application_name, tier_name="*", duration_mins=None):
+    """queries availability for every node in a tier, or in the whole application when tier_name is *, in one call.
+    returns the metric series keyed by (tier, node, agent) or None if the query failed"""
+    availability_response = get_metric("nodes", application_name, tier_name, "", "*", duration_mins)
+    availability_data, availability_data_status = validate_json(availability_response)
+
+    if availability_data_status == "error":
+        log.warning(f"        --- Batched availability query failed for {application_name} - {tier_name}, querying nodes individually.")
+        return None
+
+    node_availability = {}
+    for series in availability_data or []:
+        # Application Infrastructure Performance|<tier>|Individual Nodes|<node>|Agent|<App or Machine>|Availability
+        segments = (series.get("metricPath") or series["metricName"]).split("|")
+        if "Individual Nodes" not in segments:
+            continue
+        i = segments.index("Individual Nodes")
+        node_availability[(segments[i - 1], segments[i + 1], segments[i + 3])] = series
+
+    if DEBUG:
+        log.debug(f"        --- {len(node_availability)} node availability series returned")
+    return node_availability
+
+def fetch_application_tiers(application):
+    """retrieves and validates the tiers for an application, along with its node availability when batching per application"""
+    log.debug(f"--- {application.name} : {application.id}")
+    tiers_response = get_tiers(application.id)
+    tiers, tiers_status = validate_json(tiers_response)
+    if tiers_status == "valid":
+        tiers = [Tier.from_json(tier) for tier in tiers]
+
+    node_availability = None
+    if NODE_AVAILABILITY_BATCH == "application" and tiers_status == "valid" and tiers:
+        node_availability = fetch_node_availability(application.name, "*", lookback_windows(0, availability_window())[0])
+
+    return tiers, tiers_status, node_availability
+
+def availability_window():
+    """minutes of availability data to query - back to the previous run in incremental mode, otherwise METRIC_DURATION_MINS"""
+    if INCREMENTAL and __last_seen__["run_time"]:
+        since_last_run = int((__run_started__ - __last_seen__["run_time"]) / 60000) + INCREMENTAL_OVERLAP_MINS
+        return min(since_last_run, METRIC_DURATION_MINS)
+    return METRIC_DURATION_MINS
+
+def lookback_windows(after_mins, up_to_mins):
+    """windows to try in turn when looking for nodes - the LOOKBACK_WINDOWS_MINS steps between after_mins and
+    up_to_mins, finishing with up_to_mins itself"""
+    if not TIERED_LOOKBACK:
+        return [up_to_mins]
+    return [window for window in LOOKBACK_WINDOWS_MINS if after_mins < window < up_to_mins] + [up_to_mins]
+
+def query_node(application_name, tier_name, node, duration_mins):
+    """queries availability for a single node"""
+    if DEBUG:
+        log.debug(f"        --- Node name:{node.name}, node id: {node.id}, agenttype:{node.agent_type}")
+
+    #get node availability data
+    availability_response = get_metric("node", application_name, tier_name, node.agent_type, node.name, duration_mins)
+    availability_data, availability_data_status = validate_json(availability_response)
+    return handle_metric_response(availability_data, availability_data_status)
+
+def batched_node(tier_name, node, node_availability):
+    """picks a node's series out of a batched availability query"""
+    if DEBUG:
+        log.debug(f"        --- Node name:{node.name}, node id: {node.id}, agenttype:{node.agent_type}")
+
+    agent = "Machine" if node.agent_type == "MACHINE_AGENT" else "App"
+    series = node_availability.get((tier_name, node.name, agent))
+    return handle_metric_response([series] if series else [], "valid")
+
+def query_nodes(application_name, tier_name, nodes, node_pool, windows, node_availability=None, unresolved=None):
+    """availability (dt, value) of each node, in node order. Tries each window in turn, only asking again about the
+    nodes that were not found in the smaller one. A window is queried with one batched call for the tier when
+    batching is on and at least NODE_BATCH_MIN_NODES nodes are left to find, otherwise one call per node across the
+    node pool.
+    Pass unresolved to look for just those node indexes - the rest of the list comes back as None"""
+    availability = [None] * len(nodes)
+    if unresolved is None:
+        unresolved = list(range(len(nodes)))
+
+    for step, window in enumerate(windows):
+        if step == 0 and node_availability is not None:
+            batch = node_availability
+        elif NODE_AVAILABILITY_BATCH != "node" and len(unresolved) >= NODE_BATCH_MIN_NODES:
+            batch = fetch_node_availability(application_name, tier_name, window)
+        else:
+            batch = None
+
+        if batch is not None:
+            results = [batched_node(tier_name, nodes[i], batch) for i in unresolved]
+        else:
+            # map() hands the results back in node order whatever order the queries finish in
+            results = node_pool.map(lambda i: query_node(application_name, tier_name, nodes[i], window), unresolved)
+
+        not_found = []
+        for i, result in zip(unresolved, results):
+            availability[i] = result
+            if not isinstance(result[0], datetime.datetime):
+                not_found.append(i)
+        unresolved = not_found
+
+        if unresolved and step + 1 < len(windows):
+            log.debug(f"        --- {len(unresolved)} nodes not seen in the last {window} minutes, looking back {windows[step + 1]} minutes.")
+        else:
+            break
+
+    return availability
+
+def apply_last_seen(application_name, tier_name, nodes, availability, node_pool, duration_mins):
+    """incremental mode - fills in the nodes the short window found nothing for and records what was seen for the
+    next run. A node the previous run saw keeps that last seen time, anything else is looked up over the full window"""
+    previously_seen = __last_seen__["nodes"]
+    keys = ["|".join((application_name, tier_name, node.name)) for node in nodes]
+    unknown = []
+
+    for i, (dt, value) in enumerate(availability):
+        if isinstance(dt, datetime.datetime):
+            continue
+        if keys[i] in previously_seen:
+            last_seen_millis, last_seen_value = previously_seen[keys[i]]
+            availability[i] = datetime.datetime.fromtimestamp(last_seen_millis / 1000), last_seen_value
+        else:
+            unknown.append(i)
+
+    if unknown and duration_mins < METRIC_DURATION_MINS:
+        log.debug(f"        --- {len(unknown)} nodes not seen by the previous run, looking back up to {METRIC_DURATION_MINS} minutes for them.")
+        windows = lookback_windows(duration_mins, METRIC_DURATION_MINS)
+        for i, result in enumerate(query_nodes(application_name, tier_name, nodes, node_pool, windows, unresolved=unknown)):
+            if result is not None:
+                availability[i] = result
+
+    for key, (dt, value) in zip(keys, availability):
+        if isinstance(dt, datetime.datetime):
+            previously_seen[key] = [dt.timestamp() * 1000, value]
+
+    return availability
+
+def tier_short_circuit(nodes, tier_dt, tier_value):
+    """gives every app agent node the tier's last seen time when the tier's latest data point counts all of them.
+    Returns the availability known so far, None for each node still to query, and the indexes of those nodes"""
+    app_agents = [i for i, node in enumerate(nodes) if node.agent_type != "MACHINE_AGENT"]
+    if not app_agents or tier_value < len(app_agents):
+        return [None] * len(nodes), list(range(len(nodes)))
+
+    availability = [None] * len(nodes)
+    for i in app_agents:
+        availability[i] = (tier_dt, 1)
+    return availability, [i for i in range(len(nodes)) if availability[i] is None]
+
+def node_row(application_name, application_description, tier_name, node, dt, value):
+    """builds the CSV row for a node from its availability"""
+    if value:
+        log.debug(f"        --- Node last seen on {str(dt)}")
+    else:
+        log.debug(f"        --- Metric data not returned, message: {dt}")
+        value = ""
+    return [application_name, application_description, tier_name, node.agent_type, dt, value, node.name, node.machine_name, node.os_type, node.machine_agent_version, node.app_agent_version]
+
+def process_tier(application, tier, node_pool, node_availability=None):
+    """collects every CSV row for a tier - its availability, its nodes and each node's availability"""
+    application_id = application.id
+    application_name = application.name
+    application_description = application.description
+    tier_name = tier.name
+    tier_id = tier.id
+    tier_agent_type = tier.agent_type
+    tier_node_count = tier.node_count
+    #if DEBUG:
+    #    print(f"    --- tier name:{tier_name}, tier id: {tier_id} number of nodes: {tier_node_count} type:{tier.type}, agenttype:{tier_agent_type}")
+    #else:
+    log.debug(f"    --- tier: {tier_name}")
+    rows = []
+    duration_mins = availability_window()
+
+    #get tier availability data - over the short window only when it is used to short circuit the node queries
+    tier_window = min(TIER_SHORT_CIRCUIT_MINS, duration_mins) if TIER_SHORT_CIRCUIT else duration_mins
+    availability_response = get_metric("tier", application_name, tier_name, tier_agent_type, "null", tier_window)
+    #validate the response
+    availability_data, availability_data_status = validate_json(availability_response)
+    dt, value = handle_metric_response(availability_data, availability_data_status)
+    tier_seen = isinstance(dt, datetime.datetime)
+    short_circuit = TIER_SHORT_CIRCUIT and tier_seen
+    short_circuit_dt, short_circuit_value = dt, value
+
+    if TIER_SHORT_CIRCUIT and not tier_seen and WRITE_TIER_AVAILABILITY_DATA and tier_window < duration_mins:
+        # the tier row still reports the last time the tier was seen over the whole window
+        availability_response = get_metric("tier", application_name, tier_name, tier_agent_type, "null", duration_mins)
+        availability_data, availability_data_status = validate_json(availability_response)
+        dt, value = handle_metric_response(availability_data, availability_data_status)
+
+    if value:
+        log.debug(f"        --- Tier last seen on {str(dt)} - {str(value)} nodes seen.")
+        if WRITE_TIER_AVAILABILITY_DATA:
+            rows.append([application_name, application_description, tier_name, tier_agent_type, dt, tier_node_count, "-", "-", "-", "-", "-"])
+    else:
+        log.debug(f"        --- Metric data not returned, message: {str(dt)}")
+        if WRITE_TIER_AVAILABILITY_DATA:
+            rows.append([application_name, application_description, tier_name, tier_agent_type, dt, value, "-", "-", "-", "-", "-"])
+
+    # Get a list of all nodes for the tier
+    nodes_response = get_nodes(application_id, tier_id)
+    #validate response
+    nodes, nodes_status = validate_json(nodes_response)
+
+    #write an appropriate line if nodes are not found - rare
+    if nodes_status == "empty":
+        log.warning(f"No nodes found in {application_name} - {tier_name}")
+        rows.append([application_name, application_description, tier_name, "", "", "", "No nodes returned", "", "", "", ""])
+
+    #write an appropriate line if there was an error retrieving nodes
+    elif nodes_status == "error":
+        rows.append([application_name, application_description, tier_name, "", "", "", "ERROR retrieving nodes", "", "", "", ""])
+
+    elif nodes_status == "valid":
+        nodes = [Node.from_json(node) for node in nodes]
+        if short_circuit:
+            availability, unresolved = tier_short_circuit(nodes, short_circuit_dt, short_circuit_value)
+            log.debug(f"        --- {len(nodes) - len(unresolved)} of {len(nodes)} nodes seen with the tier, querying {len(unresolved)}.")
+        else:
+            availability, unresolved = [None] * len(nodes), None
+        if unresolved != []:
+            queried = query_nodes(application_name, tier_name, nodes, node_pool, lookback_windows(0, duration_mins), node_availability, unresolved)
+            availability = [known or result for known, result in zip(availability, queried)]
+        if INCREMENTAL:
+            availability = apply_last_seen(application_name, tier_name, nodes, availability, node_pool, duration_mins)
+
+        rows.extend(node_row(application_name, application_description, tier_name, node, dt, value) for node, (dt, value) in zip(nodes, availability))
+        __progress__.advance(len(nodes))
+
+    return rows
+
+def index_servers():
+    """streams the Server Visibility machine list and indexes every server on its host id, name and pod name, lower
+    cased. Only the columns the joined report adds are kept for each server. Where two servers share a key the live
+    one wins over a historical one. Returns the index and the status"""
+    servers_response, servers_status = get_servers()
+    server_index = {}
+    if servers_status != "valid":
+        log.error(f"Error retrieving servers, the nodes will not be joined to them: {servers_response}")
+        return server_index, servers_status
+
+    server_count = 0
+    try:
+        for server in iter_json_array(iter_response_chunks(servers_response)):
+            server = Server.from_json(server)
+            server_count += 1
+            match = (server.historical, [server.host_id, server.container_image or "", server.namespace or "", server.pod_name or "", server.agent_version])
+            for key in {server.host_id, server.name, server.pod_name} - {None, ""}:
+                key = key.lower()
+                if key not in server_index or (server_index[key][0] and not server.historical):
+                    server_index[key] = match
+    except (ValueError, KeyError, TypeError, *appd_core.HTTP_REQUEST_ERRORS) as err:
+        log.error(f"Could not read the server list, some nodes may not be joined to their server: {err}")
+        servers_status = "error"
+    log.info(f"{server_count} servers indexed for joining to the nodes")
+    return server_index, servers_status
+
+def join_servers(rows, server_index):
+    """adds the columns of the server each node runs on to the node rows, looked up on their machineName. Rows that are
+    not for a node, and nodes with no matching server, get empty columns"""
+    unmatched = (None, [""] * len(JOIN_COLUMNS))
+    joined = []
+    for row in rows:
+        machine_name = row[7]
+        if machine_name and machine_name != "-":
+            match = server_index.get(machine_name.lower(), unmatched)
+            __join_counts__["matched" if match is not unmatched else "unmatched"] += 1
+        else:
+            match = unmatched
+        joined.append(row + match[1])
+    return joined
+
+def describe_fields(value):
+    """flattens part of a health rule definition into key=value pairs, with lists joined by commas"""
+    pairs = []
+    def walk(item, key):
+        if isinstance(item, dict):
+            for child_key, child in item.items():
+                walk(child, child_key)
+        elif isinstance(item, list) and any(isinstance(child, (dict, list)) for child in item):
+            for child in item:
+                walk(child, key)
+        elif isinstance(item, list):
+            if item:
+                pairs.append(f"{key}={','.join(str(child) for child in item)}")
+        elif item is not None:
+            pairs.append(f"{key}={item}")
+    walk(value, None)
+    return " ".join(pairs)
+
+def describe_criteria(criteria):
+    """the critical or warning criteria of a health rule on one line - how its conditions combine, then each condition"""
+    if not criteria:
+        return ""
+    combined = criteria.get("conditionExpression") or criteria.get("conditionAggregationType") or ""
+    conditions = "; ".join(f"{condition.get('shortName') or condition.get('name')}: {describe_fields(condition.get('evalDetail'))}" for condition in criteria.get("conditions") or [])
+    return f"{combined} - {conditions}"
+
+def health_rule_row(application, rule):
+    """builds the row for a health rule from its definition"""
+    affects = rule.get("affects") or {}
+    criteria = rule.get("evalCriterias") or {}
+    return [
+        application.name, rule.get("name"), rule.get("enabled"), affects.get("affectedEntityType"),
+        describe_fields({key: value for key, value in affects.items() if key != "affectedEntityType"}),
+        describe_criteria(criteria.get("criticalCriteria")), describe_criteria(criteria.get("warningCriteria")),
+        rule.get("useDataFromLastNMinutes"), rule.get("scheduleName") or ""
+    ]
+
+def fetch_health_rule(application, summary):
+    """fetches the definition of one of an application's health rules and builds its row"""
+    rule, rule_status = validate_json(get_healthRule(application.id, summary.id))
+    __progress__.advance()
+    if rule_status != "valid":
+        # the rule list still says what the rule is called and what kind of entity it covers
+        return [application.name, summary.name, summary.enabled, summary.affected_entity_type, "ERROR retrieving health rule", "", "", None, ""]
+    return health_rule_row(application, rule)
+
+def fetch_health_rules(application, rule_pool):
+    """lists an application's health rules and fetches their definitions in parallel on rule_pool, returns the rows in
+    the order the controller lists the rules"""
+    log.debug(f"--- {application.name} : {application.id}")
+    rules, rules_status = validate_json(get_healthRules(application.id))
+
+    if rules_status == "error":
+        return [[application.name, "AN ERROR OCCURRED RETRIEVING HEALTH RULES", None, "", "", "", "", None, ""]]
+    if rules_status == "empty" or not rules:
+        return [[application.name, "NO HEALTH RULES FOUND", None, "", "", "", "", None, ""]]
+
+    __progress__.add_total(len(rules))
+    definitions = [rule_pool.submit(fetch_health_rule, application, HealthRule.from_json(summary)) for summary in rules]
+    return [definition.result() for definition in definitions]
+
+def export_health_rules(applications, exporter, store=None):
+    """writes out the health rules of every application, in application order. Applications are listed on one pool
+    and the rule definitions fetched on another so an application waiting on its rules never starves them"""
+    global __progress__
+    __progress__ = Progress("health rules")
+    rule_count = 0
+    with worker_pool() as application_pool, worker_pool() as rule_pool:
+        pending = collections.deque(application_pool.submit(fetch_health_rules, application, rule_pool) for application in applications)
+        while pending:
+            rows = pending.popleft().result()
+            exporter.write_rows(rows)
+            if store:
+                store.write_rows(rows)
+            rule_count += sum(1 for row in rows if row[2] is not None)
+    __progress__.finish()
+    log.info(f"{rule_count} health rules written to {OUTPUT_CSV_FILE}")
+
+def iter_business_transactions(response):
+    """yields the business transactions in a get_bts() response as they are parsed - the list comes as JSON, or as
+    XML from controllers that ignore output=json"""
+    chunks = iter_response_chunks(response)
+    if "xml" in response.headers.get("Content-Type", ""):
+        items = iter_xml_elements(chunks, "business-transaction")
+    else:
+        items = iter_json_array(chunks)
+    for item in items:
+        yield BusinessTransaction.from_json(item)
+
+def fetch_bts(application):
+    """reads an application's business transactions into rows as they stream in"""
+    log.debug(f"--- {application.name} : {application.id}")
+    bts_response, bts_status = get_bts(application.id)
+    rows = []
+    if bts_status == "valid":
+        try:
+            rows = [[application.name, bt.tier_name, bt.name, bt.entry_point_type, bt.background, bt.id] for bt in iter_business_transactions(bts_response)]
+        # SyntaxError covers the XML parser's ParseError
+        except (ValueError, KeyError, TypeError, SyntaxError, *appd_core.HTTP_REQUEST_ERRORS) as err:
+            log.error(f"Could not read the business transactions of {application.name}: {err}")
+            bts_status = "error"
+    __progress__.advance()
+
+    if bts_status == "error":
+        return [[application.name, "AN ERROR OCCURRED RETRIEVING BUSINESS TRANSACTIONS", "", "", None, None]]
+    if not rows:
+        return [[application.name, "NO BUSINESS TRANSACTIONS FOUND", "", "", None, None]]
+    return rows
+
+def export_bts(applications, exporter, store=None):
+    """writes out the business transactions of every application, in application order, fetching several
+    applications at once"""
+    global __progress__
+    __progress__ = Progress("applications")
+    __progress__.add_total(len(applications))
+    bt_count = 0
+    with worker_pool() as application_pool:
+        pending = collections.deque(application_pool.submit(fetch_bts, application) for application in applications)
+        while pending:
+            rows = pending.popleft().result()
+            exporter.write_rows(rows)
+            if store:
+                store.write_rows(rows)
+            bt_count += sum(1 for row in rows if row[5] is not None)
+    __progress__.finish()
+    log.info(f"{bt_count} business transactions written to {OUTPUT_CSV_FILE}")
+
+def transaction_name_map(application_id):
+    """maps the id of each of an application's business transactions to its name"""
+    bts_response, bts_status = get_bts(application_id)
+    names = {}
+    if bts_status == "valid":
+        try:
+            for bt in iter_business_transactions(bts_response):
+                names[bt.id] = bt.name
+        except (ValueError, KeyError, TypeError, SyntaxError, *appd_core.HTTP_REQUEST_ERRORS) as err:
+            log.warning(f"Could not read the business transactions of application {application_id}, some will show as ids: {err}")
+    return names
+
+def fetch_snapshot_slice(application_id, start_millis, end_millis):
+    """counts the snapshots of one slice of the window by business transaction, tier and error state as they stream
+    in. Returns the counts and the status - valid, timeout, error, or full when the slice hit SNAPSHOT_SLICE_MAX_RESULTS"""
+    counts = {}
+    snapshots_response, status = get_snapshots(application_id, start_millis, end_millis, SNAPSHOT_SLICE_MAX_RESULTS, SNAPSHOT_SLICE_TIMEOUT_SECS)
+    if status != "valid":
+        return counts, "timeout" if isinstance(snapshots_response, appd_core.HTTP_TIMEOUT_ERRORS) else "error"
+
+    snapshot_count = 0
+    try:
+        for snapshot in iter_json_array(iter_response_chunks(snapshots_response)):
+            snapshot_count += 1
+            key = (snapshot.get("businessTransactionId"), snapshot.get("applicationComponentId"), bool(snapshot.get("errorOccurred")))
+            # snapshots, slow snapshots, total ms, max ms
+            totals = counts.get(key)
+            if totals is None:
+                totals = counts[key] = [0, 0, 0, 0]
+            time_taken = snapshot.get("timeTakenInMilliSecs") or 0
+            totals[0] += 1
+            totals[1] += snapshot.get("userExperience") in ("SLOW", "VERY_SLOW", "STALL")
+            totals[2] += time_taken
+            totals[3] = max(totals[3], time_taken)
+    except appd_core.HTTP_REQUEST_ERRORS:
+        # requests reports a read timing out part way through the body as a ConnectionError rather than a Timeout
+        return counts, "timeout"
+    except (ValueError, KeyError, TypeError) as err:
+        log.error(f"Could not read the snapshots of application {application_id}: {err}")
+        return counts, "error"
+
+    return counts, "full" if snapshot_count >= SNAPSHOT_SLICE_MAX_RESULTS else "valid"
+
+def harvest_snapshots(application, slice_pool):
+    """fetches every slice of an application's snapshot window on slice_pool and adds up their counts as they finish,
+    splitting the slices that come back full or time out. Returns a row per business transaction, tier and error state"""
+    log.debug(f"--- {application.name} : {application.id}")
+    window_end = int(time.time() * 1000)
+    window_start = window_end - SNAPSHOT_DURATION_MINS * 60000
+    slice_millis = SNAPSHOT_SLICE_MINS * 60000
+    in_flight = {}
+    # slices are taken as they finish through their done callbacks, which also fire for slices dropped by worker_pool()
+    # when the run is interrupted - concurrent.futures.wait() is never woken for those
+    finished = queue.Queue()
+
+    def submit(slice_start, slice_end):
+        future = slice_pool.submit(fetch_snapshot_slice, application.id, slice_start, slice_end)
+        in_flight[future] = (slice_start, slice_end)
+        future.add_done_callback(finished.put)
+
+    for slice_start in range(window_start, window_end, slice_millis):
+        submit(slice_start, min(slice_start + slice_millis, window_end))
+    __progress__.add_total(len(in_flight))
+
+    # the names to show, fetched while the slices download
+    bt_names = transaction_name_map(application.id)
+    tiers, tiers_status = validate_json(get_tiers(application.id))
+    if tiers_status == "valid":
+        tiers = [Tier.from_json(tier) for tier in tiers]
+    tier_names = {tier.id: tier.name for tier in tiers} if tiers_status == "valid" else {}
+
+    counts = {}
+    full_slices = failed_slices = 0
+    while in_flight:
+        future = finished.get()
+        slice_start, slice_end = in_flight.pop(future)
+        slice_counts, status = future.result()
+        if status in ("full", "timeout") and slice_end - slice_start > SNAPSHOT_MIN_SLICE_MINS * 60000:
+            log.debug(f"        --- snapshot slice {slice_start}-{slice_end} of {application.name} was {status}, splitting it")
+            middle = (slice_start + slice_end) // 2
+            for part in ((slice_start, middle), (middle, slice_end)):
+                submit(*part)
+            __progress__.add_total(1)
+            continue
+        __progress__.advance()
+        if status in ("timeout", "error"):
+            failed_slices += 1
+            continue
+        full_slices += status == "full"
+        for key, (snapshots, slow, total_ms, max_ms) in slice_counts.items():
+            totals = counts.setdefault(key, [0, 0, 0, 0])
+            totals[0] += snapshots
+            totals[1] += slow
+            totals[2] += total_ms
+            totals[3] = max(totals[3], max_ms)
+
+    if full_slices:
+        log.warning(f"{application.name}: {full_slices} slices of {SNAPSHOT_MIN_SLICE_MINS} min still held {SNAPSHOT_SLICE_MAX_RESULTS} snapshots, its counts are a lower bound.")
+    if failed_slices:
+        log.warning(f"{application.name}: {failed_slices} slices could not be fetched, its counts leave them out.")
+    if not counts:
+        return [[application.name, "ERROR RETRIEVING SNAPSHOTS" if failed_slices else "NO SNAPSHOTS FOUND", "", None, None, None, None, None]]
+
+    rows = [
+        [application.name, tier_names.get(tier_id, str(tier_id)), bt_names.get(bt_id, str(bt_id)), error, snapshots, slow, round(total_ms / snapshots), max_ms]
+        for (bt_id, tier_id, error), (snapshots, slow, total_ms, max_ms) in counts.items()
+    ]
+    rows.sort(key=lambda row: (row[1], row[2], row[3]))
+    return rows
+
+def export_snapshots(applications, exporter, store=None):
+    """writes out the snapshot counts of every application, in application order. Applications are handled on one
+    pool and their slices fetched on another so an application waiting on its slices never starves them"""
+    global __progress__
+    __progress__ = Progress("snapshot slices")
+    snapshot_count = 0
+    with worker_pool() as application_pool, worker_pool() as slice_pool:
+        pending = collections.deque(application_pool.submit(harvest_snapshots, application, slice_pool) for application in applications)
+        while pending:
+            rows = pending.popleft().result()
+            exporter.write_rows(rows)
+            if store:
+                store.write_rows(rows)
+            snapshot_count += sum(row[4] or 0 for row in rows)
+    __progress__.finish()
+    log.info(f"{snapshot_count} snapshots counted into {OUTPUT_CSV_FILE}")
+
+def load_last_seen(state_file):
+    """reads the node last seen times saved by the previous incremental run"""
+    try:
+        with open(state_file) as state:
+            return json.load(state)
+    except FileNotFoundError:
+        log.info(f"No previous run found in {state_file}, looking back the full {METRIC_DURATION_MINS} minutes this time.")
+    except (OSError, ValueError) as err:
+        log.warning(f"Could not read {state_file} ({err}), looking back the full {METRIC_DURATION_MINS} minutes this time.")
+    return {"run_time": None, "nodes": {}}
+
+def save_last_seen(state_file):
+    """saves every node's last seen time for the next incremental run"""
+    __last_seen__["run_time"] = __run_started__
+    temp_file = state_file + ".tmp"
+    with open(temp_file, "w") as state:
+        json.dump(__last_seen__, state)
+    os.replace(temp_file, state_file)
+
+def load_checkpoint(checkpoint_file):
+    """reads back what an interrupted run finished - the (application, tier) pairs and applications it wrote, the
+    CSV offset just after the last one, its run in the inventory database and the last row it had written there by
+    then (both None without --db) and whether it ran to completion"""
+    finished_tiers = set()
+    finished_applications = set()
+    offset = run_id = rowid = None
+    complete = False
+
+    with open(checkpoint_file) as checkpoint:
+        for line in checkpoint:
+            try:
+                unit = json.loads(line)
+            except json.JSONDecodeError:
+                # a crash can leave the last line half written
+                break
+            if "tier" in unit:
+                finished_tiers.add((unit["application"], unit["tier"]))
+            elif "application" in unit:
+                finished_applications.add(unit["application"])
+            complete = unit.get("complete", False)
+            offset = unit["offset"]
+            run_id = unit.get("run_id")
+            rowid = unit.get("rowid")
+
+    return finished_tiers, finished_applications, offset, run_id, rowid, complete
+
+def record_checkpoint(checkpoint, exporter, unit, store=None):
+    """flushes the rows written so far and records the unit as done along with where its rows end in the output, and
+    in the inventory database when there is one"""
+    unit["offset"] = exporter.tell()
+    if store:
+        unit["run_id"] = store.run_id
+        unit["rowid"] = store.last_rowid
+    checkpoint.write(json.dumps(unit) + "\n")
+    checkpoint.flush()
+
+# the report's columns - all text, as one column can hold a date, a count or a message depending on the row
+CHECKUP_COLUMNS = [("Application", str), ("Description", str), ("Tier", str), ("agenttype", str), ("Last up", str), ("Last up count", str), ("Node", str), ("machineName", str), ("OS", str), ("machineAgentVersion", str), ("appAgentVersion", str)]
+
+# added to the node report's columns by --join-servers
+JOIN_COLUMNS = [("serverHostId", str), ("containerImage", str), ("namespace", str), ("podName", str), ("serverAgentVersion", str)]
+
+HEALTH_RULE_COLUMNS = [("Application", str), ("Health rule", str), ("Enabled", bool), ("Affected entity type", str), ("Affected entities", str), ("Critical criteria", str), ("Warning criteria", str), ("Evaluation mins", int), ("Schedule", str)]
+
+BT_COLUMNS = [("Application", str), ("Tier", str), ("Business transaction", str), ("Entry point type", str), ("Background", bool), ("Id", int)]
+
+SNAPSHOT_COLUMNS = [("Application", str), ("Tier", str), ("Business transaction", str), ("Error", bool), ("Snapshots", int), ("Slow snapshots", int), ("Average ms", int), ("Max ms", int)]
+
+# the reports other than the node report - what writes each one, its columns, and its table and indexes in the inventory database
+APPLICATION_REPORTS = {
+    "healthrules": (export_health_rules, HEALTH_RULE_COLUMNS, "health_rules", [("application", "health_rule", "run_id")]),
+    "bts": (export_bts, BT_COLUMNS, "business_transactions", [("application", "business_transaction", "run_id")]),
+    "snapshots": (export_snapshots, SNAPSHOT_COLUMNS, "snapshots", [("application", "business_transaction", "run_id")]),
+}
+
 #--- MAIN
-authenticate("initial")
+# run through appd, __prog__ is the command it was run as, e.g. "appd apps"
+parser = argparse.ArgumentParser(prog=globals().get("__prog__"), description="Reports on every application, tier and node in an AppDynamics controller.")
+parser.add_argument("--base-url", help=f"controller URL (default: {BASE_URL})")
+parser.add_argument("--account", help=f"controller account name (default: {APPDYNAMICS_ACCOUNT_NAME})")
+parser.add_argument("--api-client", help="API client name (default: APPDYNAMICS_API_CLIENT)")
+parser.add_argument("--api-secret", default=os.environ.get("APPDYNAMICS_API_CLIENT_SECRET"), help="API client secret (default: the APPDYNAMICS_API_CLIENT_SECRET environment variable, then APPDYNAMICS_API_CLIENT_SECRET)")
+parser.add_argument("--output", help=f"file to write (default: {OUTPUT_CSV_FILE}, with the extension of the format)")
+parser.add_argument("--report", default=REPORT, choices=["nodes", *APPLICATION_REPORTS], help="what to report on (default: %(default)s)")
+parser.add_argument("--format", default=OUTPUT_FORMAT, choices=EXPORTERS, help="output format (default: %(default)s)")
+parser.add_argument("--db", default=INVENTORY_DB, help="also add the run to this SQLite inventory database")
+parser.add_argument("--workers", type=int, default=CONCURRENT_WORKERS, help="worker threads querying the controller at once (default: %(default)s)")
+parser.add_argument("--metrics-json", help="write per endpoint request counts, errors, bytes and latencies to this JSON file")
+parser.add_argument("--metrics-prom", help="write the same request statistics to this file in the Prometheus text format")
+parser.add_argument("--resume", action="store_true", help="carry on an interrupted run, appending only the tiers it had not written yet")
+parser.add_argument("--incremental", action="store_true", help="only query availability since the previous incremental run")
+parser.add_argument("--tier-short-circuit", action="store_true", help="skip the node queries of tiers whose availability shows every node reporting")
+parser.add_argument("--join-servers", action="store_true", help="add the Server Visibility server each node runs on - its container image, namespace, pod and machine agent version")
+parser.add_argument("--no-cache", action="store_true", help="do not read or write the on-disk cache of applications, tiers and nodes")
+parser.add_argument("--refresh", action="store_true", help="ignore cached applications, tiers and nodes and fetch them all again")
+parser.add_argument("--log-level", default=LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="console messages to show (default: %(default)s)")
+parser.add_argument("--log-file", help="also write the messages to this file, INFO and up or everything with --log-level DEBUG")
+args = parser.parse_args()
+setup_logging(args.log_level, args.log_file)
+# the detailed per query messages are only built when something will show them
+DEBUG = log.isEnabledFor(logging.DEBUG)
+if args.account and args.account != APPDYNAMICS_ACCOUNT_NAME:
+    # the default file names and SaaS controller URL are built from the account name, they follow it
+    OUTPUT_CSV_FILE = OUTPUT_CSV_FILE.replace(APPDYNAMICS_ACCOUNT_NAME, args.account, 1)
+    INCREMENTAL_STATE_FILE = INCREMENTAL_STATE_FILE.replace(APPDYNAMICS_ACCOUNT_NAME, args.account, 1)
+    BASE_URL = BASE_URL.replace("//" + APPDYNAMICS_ACCOUNT_NAME + ".", "//" + args.account + ".", 1)
+    APPDYNAMICS_ACCOUNT_NAME = args.account
+BASE_URL = (args.base_url or BASE_URL).rstrip("/")
+APPDYNAMICS_API_CLIENT = args.api_client or APPDYNAMICS_API_CLIENT
+APPDYNAMICS_API_CLIENT_SECRET = args.api_secret or APPDYNAMICS_API_CLIENT_SECRET
+OUTPUT_FORMAT = args.format
+INVENTORY_DB = args.db
+if args.workers < 1:
+    parser.error("--workers must be at least 1")
+if args.workers != CONCURRENT_WORKERS:
+    # the connection pool grows with the workers so none of them waits for a connection
+    CONCURRENT_WORKERS = args.workers
+    HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, CONCURRENT_WORKERS * 2)
+REPORT = args.report
+if args.join_servers:
+    JOIN_SERVERS = True
+if args.output:
+    OUTPUT_CSV_FILE = args.output
+else:
+    if REPORT == "nodes" and JOIN_SERVERS:
+        OUTPUT_CSV_FILE = OUTPUT_CSV_FILE.replace("_checkup_", "_checkup_servers_", 1)
+    elif REPORT != "nodes":
+        OUTPUT_CSV_FILE = OUTPUT_CSV_FILE.replace("_checkup_", "_" + REPORT + "_", 1)
+    OUTPUT_CSV_FILE = os.path.splitext(OUTPUT_CSV_FILE)[0] + EXPORTERS[OUTPUT_FORMAT].extension
+CHECKPOINT_FILE = OUTPUT_CSV_FILE + ".checkpoint"
+if REPORT != "nodes" and (args.resume or args.incremental or JOIN_SERVERS):
+    parser.error("--resume, --incremental and --join-servers only apply to the nodes report")
+if args.resume and not EXPORTERS[OUTPUT_FORMAT].resumable:
+    parser.error(f"--resume is not supported for {OUTPUT_FORMAT} output, it is only written once the run finishes")
+if args.incremental:
+    INCREMENTAL = True
+if args.resume and INCREMENTAL:
+    # the tiers a resumed run skips would never have their nodes' last seen times refreshed, yet the saved run time
+    # would move on and the next incremental run would look back too short a time for them
+    parser.error("--resume cannot be used with --incremental (or INCREMENTAL = True), run again without --resume")
+if args.tier_short_circuit:
+    TIER_SHORT_CIRCUIT = True
+if args.no_cache:
+    USE_CACHE = False
+if args.refresh:
+    REFRESH_CACHE = True
+
+finished_tiers, finished_applications, resume_offset, resume_run_id, resume_rowid = set(), set(), None, None, None
+if args.resume:
+    if os.path.exists(CHECKPOINT_FILE) and os.path.exists(OUTPUT_CSV_FILE):
+        finished_tiers, finished_applications, resume_offset, resume_run_id, resume_rowid, complete = load_checkpoint(CHECKPOINT_FILE)
+        if complete:
+            log.info(f"{OUTPUT_CSV_FILE} is already complete, nothing to resume.")
+            sys.exit(0)
+        log.info(f"Resuming {OUTPUT_CSV_FILE} - {len(finished_applications)} applications and {len(finished_tiers)} tiers already written.")
+    else:
+        log.info(f"No checkpoint found for {OUTPUT_CSV_FILE}, starting a fresh run.")
+
+__run_started__ = time.time() * 1000
+__last_seen__ = load_last_seen(INCREMENTAL_STATE_FILE) if INCREMENTAL else None
+
+appd_core.configure(globals())
+appd_core.login()
 
 #Get applications
 applications_response = get_applications()
 #Validate response
 applications, applications_status = validate_json(applications_response)
 
-if applications_status == "valid":
-    # Open the output CSV file for writing and write the header row
-    print("Writing to CSV file: " + OUTPUT_CSV_FILE)
-    with open(OUTPUT_CSV_FILE, "w", newline='') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerow(["Application", "Description", "Tier", "agenttype", "Last up", "Last up count", "Node", "machineName", "OS", "machineAgentVersion", "appAgentVersion"])
-
-        # Iterate over each application and start the output
-        for application in applications:
-            application_id = application["id"]
-            application_name = application["name"]
-            application_description = application["description"]
-            print(f"--- {application_name} : {application_id}")
-
-            #retrieve tiers for the app
-            tiers_response = get_tiers(application_id)
-            #validate response
-            tiers, tiers_status = validate_json(tiers_response)
-            
-            if tiers_status == "error":
-                csv_writer.writerow([application_name, application_description, "AN ERROR OCCURRED RETRIEVING TIERS", "", "", "", "", "", "", "", ""])
-                continue # do not stop processing through tiers because of an error pulling its tiers
-            
-            if tiers_status == "empty":
-                csv_writer.writerow([application_name, application_description, "NO TIERS FOUND", "", "", "", "", "", "", "", ""])
-                continue # do not stop processing through applications because they do not have tiers
-
-            if (tiers_status == "valid"):
-                if tiers == []:
-                    csv_writer.writerow([application_name, application_description, "NO TIERS FOUND", "", "", "", "", "", "", "", ""])
-                    continue # do not stop processing through applications because they do not have tiers
-
-                # Iterate over each tier in the application
-                for tier in tiers:
-                    tier_name = tier["name"]
-                    tier_id = tier["id"]
-                    tier_type = tier["type"]
-                    tier_agent_type = tier["agentType"]
-                    tier_node_count = tier["numberOfNodes"]
-                    #if DEBUG:
-                    #    print(f"    --- tier name:{tier_name}, tier id: {tier_id} number of nodes: {tier_node_count} type:{tier_type}, agenttype:{tier_agent_type}")
-                    #else:
-                    print(f"    --- tier: {tier_name}")
-                    
-                    #get tier availability data
-                    availability_response = get_metric("tier", application_name, tier_name, tier_agent_type, "null")
-                    #validate the response                
-                    availability_data, availability_data_status = validate_json(availability_response)
-                    dt, value = handle_metric_response(availability_data, availability_data_status)
-                    
-                    if value:
-                        print(f"        --- Tier last seen on {str(dt)} - {str(value)} nodes seen.")
-                        if WRITE_TIER_AVAILABILITY_DATA:    
-                            csv_writer.writerow([application_name, application_description, tier_name, tier_agent_type, dt, tier_node_count, "-", "-", "-", "-", "-"])
-                    else:
-                        print(f"        --- Metric data not returned, message: {str(dt)}")
-                        if WRITE_TIER_AVAILABILITY_DATA:    
-                            csv_writer.writerow([application_name, application_description, tier_name, tier_agent_type, dt, value, "-", "-", "-", "-", "-"])
-                    
-                    # Get a list of all nodes for the tier
-                    nodes_response = get_nodes(application_id, tier_id)
-                    #validate response
-                    nodes_data = validate_json(nodes_response)
-                    nodes, nodes_status = nodes_data
-
-                    #write an appropriate line if nodes are not found - rare
-                    if nodes_status == "empty":
-                        print("        --- NO NODES FOUND!")
-                        csv_writer.writerow([application_name, application_description, tier_name, "", "", "", "No nodes returned", "", "", "", ""])
-                        continue # do not stop processing through tiers because the tier is empty - consider deleting the tier...
-
-                    #write an appropriate line if there was an error retrieving nodes
-                    elif nodes_status == "error":
-                        csv_writer.writerow([application_name, application_description, tier_name, "", "", "", "ERROR retrieving nodes", "", "", "", ""])
-                        continue # do not stop processing through tiers because of an error pulling its nodes
-                            
-                    # Iterate over each node in the tier and write to the CSV
-                    elif nodes_status == "valid":
-                        for node in nodes:
-                            node_id = node["id"]
-                            node_name = node["name"]
-                            node_machineName = node["machineName"]
-                            node_machineOSType = node["machineOSType"]
-                            node_machineAgentVersion = node["machineAgentVersion"]
-                            node_appAgentVersion = node["appAgentVersion"]
-                            node_agent_type = node["agentType"]
-                            if DEBUG:
-                                print(f"        --- Node name:{node_name}, node id: {node_id}, agenttype:{node_agent_type}")
-                            else:
-                                print(f"        --- {node_name}")
-                                                        
-                            #get node availability data
-                            availability_response = get_metric("node", application_name, tier_name, node_agent_type, node_name)
-                            availability_data, availability_data_status = validate_json(availability_response)
-                            dt, value = handle_metric_response(availability_data, availability_data_status)
-                            
-                            if value:
-                                print(f"        --- Node last seen on {str(dt)}")
-                                csv_writer.writerow([application_name, application_description, tier_name, node_agent_type, dt, value, node_name, node_machineName, node_machineOSType, node_machineAgentVersion, node_appAgentVersion])
-
-                            else:
-                                print(f"        --- Metric data not returned, message: {dt}")
-                                csv_writer.writerow([application_name, application_description, tier_name, node_agent_type, dt, "", node_name, node_machineName, ßnode_machineOSType, node_machineAgentVersion, node_appAgentVersion])                   
+if applications_status == "valid" and REPORT in APPLICATION_REPORTS:
+    applications = [Application.from_json(application) for application in applications]
+    export, columns, table, indexes = APPLICATION_REPORTS[REPORT]
+    log.info(f"Writing to {OUTPUT_FORMAT} file: " + OUTPUT_CSV_FILE)
+    store = InventoryStore(INVENTORY_DB, REPORT, table, columns, indexes) if INVENTORY_DB else contextlib.nullcontext()
+    with EXPORTERS[OUTPUT_FORMAT](OUTPUT_CSV_FILE, columns) as exporter, store:
+        export(applications, exporter, store if INVENTORY_DB else None)
+    trim_cache()
+    print_request_stats()
+    write_request_stats(REPORT, args.metrics_json, args.metrics_prom)
+
+elif applications_status == "valid":
+    applications = [Application.from_json(application) for application in applications]
+    if resume_offset is not None:
+        # drop any rows written after the last checkpoint, they belong to a tier that never finished
+        os.truncate(OUTPUT_CSV_FILE, resume_offset)
+        log.info(f"Appending to {OUTPUT_FORMAT} file: " + OUTPUT_CSV_FILE)
+    else:
+        log.info(f"Writing to {OUTPUT_FORMAT} file: " + OUTPUT_CSV_FILE)
+    mode = "a" if resume_offset is not None else "w"
+
+    # the joined rows have more columns, they get a table of their own
+    columns = CHECKUP_COLUMNS + JOIN_COLUMNS if JOIN_SERVERS else CHECKUP_COLUMNS
+    table = "app_nodes_servers" if JOIN_SERVERS else "app_nodes"
+    store = InventoryStore(INVENTORY_DB, "checkup", table, columns, [("application", "tier", "node", "run_id")], run_id=resume_run_id) if INVENTORY_DB else contextlib.nullcontext()
+    servers_status = None
+
+    with EXPORTERS[OUTPUT_FORMAT](OUTPUT_CSV_FILE, columns, append=resume_offset is not None) as exporter, open(CHECKPOINT_FILE, mode) as checkpoint, store:
+        if resume_offset is None:
+            # the exporter has written its header, if it has one
+            record_checkpoint(checkpoint, exporter, {"header": True}, store if INVENTORY_DB else None)
+        elif INVENTORY_DB and resume_rowid is not None and store.run_id == resume_run_id:
+            # the same goes for the database - rows can be committed there before their checkpoint is written
+            deleted = store.truncate(resume_rowid)
+            if deleted:
+                log.info(f"Dropped {deleted} rows from {INVENTORY_DB} written after the last checkpoint.")
+
+        # tiers are crawled on one pool and nodes on another so a tier waiting on its nodes never starves the node queries,
+        # and the server list gets a thread of its own so it never holds up the tiers either
+        with worker_pool() as tier_pool, worker_pool() as node_pool, worker_pool(1) as server_pool:
+
+            __progress__ = Progress("nodes")
+
+            # the server list downloads and is indexed while the first tiers are crawled
+            if JOIN_SERVERS:
+                server_index = server_pool.submit(index_servers)
+
+            # rows for each unit of work queued in output order, written and checkpointed as soon as everything ahead of them is done
+            pending = collections.deque()
+
+            def write_finished(wait=False):
+                while pending and (wait or pending[0][1].done()):
+                    unit, future = pending.popleft()
+                    rows = future.result()
+                    if JOIN_SERVERS:
+                        rows = join_servers(rows, server_index.result()[0])
+                    exporter.write_rows(rows)
+                    if INVENTORY_DB:
+                        store.write_rows(rows)
+                    record_checkpoint(checkpoint, exporter, unit, store if INVENTORY_DB else None)
+
+            # fetch the tiers of every application still to do up front, in parallel
+            application_tiers = [(application, tier_pool.submit(fetch_application_tiers, application)) for application in applications if application.id not in finished_applications]
+
+            # Iterate over each application and queue up its tiers
+            for application, tiers_future in application_tiers:
+                application_id = application.id
+                application_name = application.name
+                application_description = application.description
+                tiers, tiers_status, node_availability = tiers_future.result()
+                rows = []
+
+                if tiers_status == "error":
+                    rows.append([application_name, application_description, "AN ERROR OCCURRED RETRIEVING TIERS", "", "", "", "", "", "", "", ""])
+                    # do not stop processing through tiers because of an error pulling its tiers
+
+                elif tiers_status == "empty" or tiers == []:
+                    rows.append([application_name, application_description, "NO TIERS FOUND", "", "", "", "", "", "", "", ""])
+                    # do not stop processing through applications because they do not have tiers
+
+                elif tiers_status == "valid":
+                    for tier in tiers:
+                        if (application_id, tier.id) in finished_tiers:
+                            continue
+                        __progress__.add_total(tier.node_count or 0)
+                        pending.append(({"application": application_id, "tier": tier.id}, tier_pool.submit(process_tier, application, tier, node_pool, node_availability)))
+
+                # the application is done once everything queued ahead of this marker is written
+                pending.append(({"application": application_id}, completed(rows)))
+                write_finished()
+
+            write_finished(wait=True)
+            __progress__.finish()
+            if JOIN_SERVERS:
+                servers_status = server_index.result()[1]
+                log.info(f"{__join_counts__['matched']} nodes joined to their server, {__join_counts__['unmatched']} with no matching server")
+
+        record_checkpoint(checkpoint, exporter, {"complete": True}, store if INVENTORY_DB else None)
+
+    if INCREMENTAL:
+        save_last_seen(INCREMENTAL_STATE_FILE)
+    trim_cache()
+    print_request_stats()
+    write_request_stats("checkup", args.metrics_json, args.metrics_prom)
+    if servers_status == "error":
+        sys.exit(1)
 
 else:
-    print(f"No applications returned. Status: {applications_status}")
-    sys.exit(1)
\ No newline at end of file
+    log.error(f"No applications returned. Status: {applications_status}")
+    write_request_stats("checkup" if REPORT == "nodes" else REPORT, args.metrics_json, args.metrics_prom)
+    sys.exit(1)
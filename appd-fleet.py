@@ -0,0 +1,155 @@
+# Runs appd-checkup.py and appd-servers-checkup.py against a whole fleet of controllers at once and prints a merged
+# summary at the end. Each controller runs in processes of its own, with its own login, rate limit and output files,
+# so the sweep takes about as long as the slowest controller rather than the sum of them all.
+# usage: python appd-fleet.py controllers.json [--scripts checkup,servers] [--output-dir fleet] [--summary fleet.json] [-- extra script args]
+# for questions / help contact Robert Vandervoort - rvander2@cisco.com
+# CHEERS!
+
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import concurrent.futures
+
+#--- CONFIGURATION SECTION ---
+"""
+The controllers file is a JSON list with one object per controller:
+[
+    {"name": "prod-us", "base_url": "https://produs.saas.appdynamics.com", "account": "produs",
+     "api_client": "checkup", "api_secret_env": "PROD_US_SECRET"},
+    {"name": "onprem", "base_url": "https://appd.example.com:8181", "account": "customer1",
+     "api_client": "checkup", "api_secret": "...", "scripts": ["checkup"],
+     "args": {"checkup": ["--incremental", "--db", "onprem.db"], "servers": ["--format", "parquet"]}}
+]
+name is used for the controller's output directory. The secret is best kept out of the file - api_secret_env names the
+environment variable holding it. scripts limits which scripts run for that controller. args holds extra options for
+each script, keyed by the script's name in SCRIPTS, as the scripts take different options - --incremental and
+--resume for instance are only for checkup. Anything else a script takes on its command line can go there too.
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# each script, with the name used for it on the command line and in the summary
+SCRIPTS = {
+    "checkup": "appd-checkup.py",
+    "servers": "appd-servers-checkup.py",
+}
+
+#---FUNCTION DEFINITIONS
+def load_controllers(path):
+    """reads the controllers file and checks every controller has what it needs to log in"""
+    with open(path) as controllers_file:
+        controllers = json.load(controllers_file)
+    names = set()
+    for controller in controllers:
+        for key in ("name", "base_url", "account", "api_client"):
+            if not controller.get(key):
+                sys.exit(f"{path}: every controller needs a {key} - {controller}")
+        if controller["name"] in names:
+            sys.exit(f"{path}: the controller name {controller['name']} is used twice")
+        names.add(controller["name"])
+        if controller.get("api_secret_env") and controller["api_secret_env"] not in os.environ:
+            sys.exit(f"{controller['name']}: the environment variable {controller['api_secret_env']} is not set")
+        if not isinstance(controller.get("args", {}), dict) or not set(controller.get("args", {})) <= set(SCRIPTS):
+            sys.exit(f"{controller['name']}: args must map script names ({', '.join(SCRIPTS)}) to lists of options")
+    return controllers
+
+def run_script(controller, script, output_dir, extra_args):
+    """runs one script against one controller to completion in the controller's output directory, returns how it went"""
+    command = [sys.executable, os.path.join(HERE, SCRIPTS[script]),
+               "--base-url", controller["base_url"], "--account", controller["account"], "--api-client", controller["api_client"],
+               "--metrics-json", f"{script}_metrics.json"] + extra_args + controller.get("args", {}).get(script, [])
+    # the secret goes through the environment so it does not show up in the process list
+    environment = dict(os.environ)
+    environment["APPDYNAMICS_API_CLIENT_SECRET"] = os.environ[controller["api_secret_env"]] if controller.get("api_secret_env") else controller.get("api_secret", "")
+
+    metrics_file = os.path.join(output_dir, f"{script}_metrics.json")
+    if os.path.exists(metrics_file):
+        os.remove(metrics_file)
+    started = time.perf_counter()
+    with open(os.path.join(output_dir, f"{script}.log"), "w") as log:
+        exit_code = subprocess.call(command, cwd=output_dir, env=environment, stdout=log, stderr=subprocess.STDOUT)
+    result = {"controller": controller["name"], "script": script, "exit_code": exit_code, "wall_secs": round(time.perf_counter() - started, 1), "endpoints": {}}
+    if os.path.exists(metrics_file):
+        with open(metrics_file) as metrics:
+            result["endpoints"] = json.load(metrics)["endpoints"]
+    return result
+
+def run_controller(controller, scripts, output_root, extra_args):
+    """runs the scripts for one controller one after the other, so the controller only ever sees one of them at a time"""
+    output_dir = os.path.join(output_root, controller["name"])
+    os.makedirs(output_dir, exist_ok=True)
+    results = []
+    for script in controller.get("scripts", scripts):
+        result = run_script(controller, script, output_dir, extra_args)
+        status = "ok" if result["exit_code"] == 0 else f"FAILED with exit code {result['exit_code']}, see {os.path.join(output_dir, script + '.log')}"
+        print(f"--- {controller['name']} {script}: {status} in {result['wall_secs']}s", flush=True)
+        results.append(result)
+    return results
+
+def merge_endpoints(results):
+    """adds up the request statistics of every run per endpoint. Percentiles cannot be added up, the total latency is
+    kept instead"""
+    totals = {}
+    for result in results:
+        for family, stats in result["endpoints"].items():
+            total = totals.setdefault(family, {"requests": 0, "errors": 0, "bytes": 0, "cache_hits": 0, "waited_secs": 0.0, "latency_secs_total": 0.0})
+            for key in total:
+                total[key] += stats.get(key, 0)
+    for total in totals.values():
+        total["waited_secs"] = round(total["waited_secs"], 3)
+        total["latency_secs_total"] = round(total["latency_secs_total"], 3)
+    return dict(sorted(totals.items()))
+
+def print_summary(results, wall_secs):
+    """prints one line per controller and script, then the fleet's totals"""
+    print(f"\n{'controller':<20}{'script':<10}{'exit':>6}{'wall s':>10}{'requests':>10}{'errors':>8}{'MB':>9}")
+    for result in results:
+        endpoints = result["endpoints"].values()
+        print(f"{result['controller']:<20}{result['script']:<10}{result['exit_code']:>6}{result['wall_secs']:>10}"
+              f"{sum(stats['requests'] for stats in endpoints):>10}{sum(stats['errors'] for stats in endpoints):>8}{sum(stats['bytes'] for stats in endpoints) / 1048576:>9.2f}")
+
+    totals = merge_endpoints(results)
+    failed = sum(1 for result in results if result["exit_code"] != 0)
+    print(f"\n{len(results)} runs across {len({result['controller'] for result in results})} controllers in {wall_secs:.1f}s, {failed} failed. "
+          f"Their runs added up to {sum(result['wall_secs'] for result in results):.1f}s.")
+    if totals:
+        print(f"    {'endpoint':<24}{'requests':>9}{'errors':>8}{'cached':>8}{'MB':>9}")
+        for family, stats in totals.items():
+            print(f"    {family:<24}{stats['requests']:>9}{stats['errors']:>8}{stats['cache_hits']:>8}{stats['bytes'] / 1048576:>9.2f}")
+
+#--- MAIN
+# run through appd, __prog__ is the command it was run as, e.g. "appd apps"
+parser = argparse.ArgumentParser(prog=globals().get("__prog__"), description="Runs the checkup scripts against every controller in a list, in parallel.")
+parser.add_argument("controllers", help="JSON file listing the controllers")
+parser.add_argument("--scripts", default=",".join(SCRIPTS), help="comma separated scripts to run for each controller (default: %(default)s)")
+parser.add_argument("--workers", type=int, help="controllers to run at once (default: all of them)")
+parser.add_argument("--output-dir", default="fleet_" + datetime.date.today().strftime("%m-%d-%Y"), help="each controller's reports and logs go in a directory of its own under this one (default: %(default)s)")
+parser.add_argument("--summary", help="also write the merged summary, with every run's request statistics, to this JSON file")
+args, extra_args = parser.parse_known_args()
+# anything else on the command line is passed on to every script, e.g. --format parquet
+if extra_args[:1] == ["--"]:
+    extra_args = extra_args[1:]
+
+scripts = args.scripts.split(",")
+for script in scripts:
+    if script not in SCRIPTS:
+        parser.error(f"unknown script {script}, choose from {', '.join(SCRIPTS)}")
+controllers = load_controllers(args.controllers)
+
+print(f"Running {', '.join(scripts)} against {len(controllers)} controllers, reports in {args.output_dir}")
+started = time.perf_counter()
+with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers or len(controllers) or 1) as pool:
+    runs = [pool.submit(run_controller, controller, scripts, args.output_dir, extra_args) for controller in controllers]
+    results = [result for run in runs for result in run.result()]
+wall_secs = time.perf_counter() - started
+
+print_summary(results, wall_secs)
+if args.summary:
+    with open(args.summary, "w") as summary:
+        json.dump({"wall_secs": round(wall_secs, 1), "runs": results, "totals": merge_endpoints(results)}, summary, indent=2)
+
+sys.exit(1 if any(result["exit_code"] != 0 for result in results) else 0)
@@ -5,19 +5,31 @@
 # for questions / help contact Robert Vandervoort - rvander2@cisco.com
 # CHEERS!
 
+import os
 import sys
-import json
-import csv
+import contextlib
+import argparse
+import collections
+import concurrent.futures
 import datetime
-import time
-import urllib.parse
-import requests
+import threading
+import logging
+import asyncio
+# the login, session, rate limiting, retries, statistics, logging, parsers and exporters shared with appd-checkup.py
+import appd_core
+from appd_core import log, Server, EXPORTERS, InventoryStore, Progress, setup_logging, handle_rest_errors, controller_get, iter_response_chunks, iter_json_array, print_request_stats, write_request_stats
 
 #--- CONFIGURATION SECTION ---
 # print debug info set DEBUG to True if you need to get RICH details about what is going on..
 # will flood the console when running against a decent sized controller.
 DEBUG = False
 
+# Console messages - "DEBUG", "INFO", "WARNING" or "ERROR". INFO shows a progress line with the rate and time left every
+# PROGRESS_INTERVAL_SECS seconds, DEBUG adds a line for every query. Can also be set with --log-level, and --log-file
+# writes the messages, INFO and up or everything at DEBUG, to a file with timestamps and thread names.
+LOG_LEVEL = "DEBUG" if DEBUG else "INFO"
+PROGRESS_INTERVAL_SECS = 10
+
 #Replace with your AppDynamics API client details
 APPDYNAMICS_ACCOUNT_NAME = "account"
 APPDYNAMICS_API_CLIENT = "api_client_name"
@@ -34,6 +46,16 @@ WRITE_TIER_AVAILABILITY_DATA = False
 #OUTPUT_CSV_FILE = "output.csv"
 OUTPUT_CSV_FILE = APPDYNAMICS_ACCOUNT_NAME+"_servers_"+datetime.date.today().strftime("%m-%d-%Y")+".csv"
 
+# Output format - "csv", "jsonl" (a JSON object per line) or "parquet" (needs pyarrow - pip install pyarrow). JSON Lines
+# and Parquet keep lists and dicts as real nested values rather than their text, and Parquet loads far quicker into
+# analysis tools. The extension of the output file follows the format. Can also be set with --format.
+OUTPUT_FORMAT = "csv"
+
+# Optionally keep the inventory of every run in a SQLite database as well (or run with --db <file>), to query it across
+# runs - which nodes went dark since last week, how agent versions drifted over the last 90 days and so on. Each run is
+# added to the runs table, and its rows go in a table of their own with the run's id. Leave empty to skip it.
+INVENTORY_DB = ""
+
 # Set the base URL for the AppDynamics REST API
 # --- replace this with your on-prem controller URL if you're on prem
 BASE_URL = "https://"+APPDYNAMICS_ACCOUNT_NAME+".saas.appdynamics.com"
@@ -42,624 +64,362 @@ BASE_URL = "https://"+APPDYNAMICS_ACCOUNT_NAME+".saas.appdynamics.com"
 VERIFY_SSL = True
 
 """
-Set this METRIC_DURATION_MINS variable to how far you want to look back in time to find the last time agents 
-reported in. The value is in minutes. Depending on how far you look back, data will be aggregated. If you go 
-back 12 months, you'll get 1 hour data points. Data is only retained for 13 months max. The father you go back 
-the longer the script will take to run. I would recommend for your first time running this you go back a year 
-or since you deployed, whichever is less. For subsequent runs, decrease the time considerably. Three examples 
-follow. Ensure only one option is uncommented.
+The server list can be fetched in pages of SIM_PAGE_SIZE servers, with up to CONCURRENT_WORKERS pages requested at
+once while the rows of pages that already arrived are written out. Only turn this on if your controller supports the
+offset and limit parameters on /controller/sim/v2/user/machines, otherwise leave it at 0 to fetch the whole list in one
+request (still written out as it is parsed). CONCURRENT_WORKERS can also be set with --workers.
 """
-#METRIC_DURATION_MINS = 525600 #12 months
-METRIC_DURATION_MINS = 43800 #1 month
-#METRIC_DURATION_MINS = 1440 #1 day
-#METRIC_DURATION_MINS = 240 #4 hours
-#METRIC_DURATION_MINS = 5 #5 mins
+SIM_PAGE_SIZE = 0
+CONCURRENT_WORKERS = 4
+
+# The server list is parsed as it downloads and handed to the CSV writer this many servers at a time, so memory use
+# stays flat however many servers and containers the controller tracks.
+SERVER_BATCH_SIZE = 500
 
 """
-Also, metric rollups may be considered when using broader time ranges, however the last up date will represent 
-the earliest data point in the series instead of the actual last time it reported in. see the doc:
-https://docs.appdynamics.com/appd/24.x/latest/en/extend-appdynamics/appdynamics-apis/metric-and-snapshot-api#MetricandSnapshotAPI-DataRetentionforMetricandSnapshotAPI
+Every call to the controller goes through one shared HTTP session that keeps its connections open and reuses them,
+so we only pay for the TCP and TLS handshakes once per connection instead of once per request. HTTP_POOL_SIZE is the
+number of connections kept open - there is no point having it lower than the number of requests in flight.
+Set HTTP2 to True to talk HTTP/2 to the controller, this needs the httpx package with its http2 extra installed
+(pip install "httpx[http2]"). If httpx is missing we fall back to HTTP/1.1 with keep-alive.
 """
-METRIC_ROLLUP = "false"
+HTTP_POOL_SIZE = CONCURRENT_WORKERS
+HTTP2 = False
 
-#manages token expiration - do not change these values
-last_token_fetch_time = ""
-token_expiration = 300
-expiration_buffer = 30
+"""
+Controller API rate limiting. MAX_REQUESTS_PER_SECOND caps how fast requests are sent (0 turns the cap off) and
+MAX_IN_FLIGHT_REQUESTS caps how many can be outstanding at once. If the controller throttles us with a 429 the rate
+is halved, then it creeps back up towards MAX_REQUESTS_PER_SECOND while requests succeed, so we settle at whatever
+the controller can take. Throttled (429), overloaded (500, 502, 503, 504) and dropped requests are retried up to
+MAX_RETRIES times. We wait RETRY_BACKOFF_SECS before the first retry and double that each time, capped at
+RETRY_BACKOFF_MAX_SECS, with random jitter so parallel workers do not retry in lock step. If the controller sends a
+Retry-After header we wait as long as it asks instead.
+"""
+MAX_REQUESTS_PER_SECOND = 50
+MAX_IN_FLIGHT_REQUESTS = 20
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECS = 1
+RETRY_BACKOFF_MAX_SECS = 60
+
+#progress - do not change these values
+__progress__ = None
+# set when the crawl ends early, so the workers stop handing servers to a writer that is gone
+__stopping__ = threading.Event()
+# properties missing from what the controller returned, counted per property instead of reported one by one
+__missing_keys__ = collections.Counter()
 
 #---FUNCTION DEFINITIONS
-def authenticate(state):
-    """get XCSRF token for use in this session"""
-    if state == "reauth":
-        print("Obtaining a freah authentication token.")
-    if state == "initial":
-        print("Begin login.")
-    
-    connect(APPDYNAMICS_ACCOUNT_NAME, APPDYNAMICS_API_CLIENT, APPDYNAMICS_API_CLIENT_SECRET)
-    
-    return
-
-def is_token_valid():
-    """Checks if the access token is valid and not expired."""
-    if DEBUG:
-        print("Checking token validity...")
-
-    if __session__ is None:
-        if DEBUG:
-            print("__session__ not found or empty.")
-        return False
-
-    # Conservative buffer (e.g., 30 seconds before expiration)
-    if DEBUG:
-        print(f"__session__: {__session__}")
-    return time.time() < (token_expiration + last_token_fetch_time - expiration_buffer)
-
-def connect(account, apiclient, secret):
-    """Connects to the AppDynamics API and retrieves an OAuth token."""
-    global __session__, last_token_fetch_time, token_expiration
-    __session__ = requests.Session()
-
-    url = f"{BASE_URL}/controller/api/oauth/access_token?grant_type=client_credentials&client_id={apiclient}@{account}&client_secret={secret}"
-    payload = {} 
-    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-
-    print(f"Logging into the controller at: {BASE_URL}")
-
-    @handle_rest_errors  # Apply the error handling decorator
-    def make_auth_request():
-        response = __session__.request(
-            "POST",
-            url,
-            headers=headers,
-            data=payload,
-            verify=VERIFY_SSL
-        )
-        return response
-
-    auth_response, status = make_auth_request()
-    if DEBUG:
-        print(f"Authentication response:{auth_response} = {status}")
-
-    # Assuming auth_response isn't None if no errors occurred
-    if status == "valid":
-        if auth_response:
-            json_response = auth_response.json()
-            last_token_fetch_time = time.time()
-            token_expiration = json_response['expires_in']
-    else:
-        print(f"Unable to log in at: {BASE_URL}")
-        print("Please check your controller URL and try again.")
-        sys.exit(9)
-
-    __session__.headers['X-CSRF-TOKEN'] = json_response['access_token']
-    __session__.headers['Authorization'] = f'Bearer {json_response["access_token"]}'
-    
-    print("Authenticated with controller.")
-    
-    if DEBUG:
-        print(f"Last token fetch time: {last_token_fetch_time}")
-        print(f"Token expires in: {json_response['expires_in']}")
-        print(f"Session headers: {__session__.headers}")
-    
-    return True
-
-def handle_rest_errors(func):
-    """for handling REST calls"""
-    def inner_function(*args, **kwargs):
-        error_map = {
-            400: "Bad Request - The request was invalid.",
-            401: "Unauthorized - Authentication failed.",
-            403: "Forbidden - You don't have permission to access this resource.",
-            404: "Not Found - The resource could not be found.",
-            500: "Internal Server Error - Something went wrong on the server.",
-        }
-
-        try:
-            response = func(*args, **kwargs)
-            response.raise_for_status()
-            return response, "valid"
-        except requests.exceptions.HTTPError as err:
-            error_code = err.response.status_code
-            error_explanation = error_map.get(error_code, "Unknown HTTP Error")
-            print(f"HTTP Error: {error_code} - {error_explanation}")
-            return error_explanation, "error"
-        except requests.exceptions.RequestException as err:
-            if isinstance(err, requests.exceptions.ConnectionError):
-                print("Connection Error: Failed to establish a new connection.")
-                return err, "error"
-            else: 
-                print(f"Request Exception: {err}") 
-                return err, "error"
-        except Exception:  
-            error_type, error_value, _ = sys.exc_info() 
-            print(f"Unexpected Error: {error_type.__name__}: {error_value}")
-            return error_value, "error"
-
-    return inner_function
-
-def urlencode_string(text):
-    """make app, tier or node names URL compatible for the REST call"""
-    # Replace spaces with '%20'
-    text = text.replace(' ', '%20')
-
-    # Encode the string using the 'safe' scheme
-    safe_characters = '-_.!~*\'()[]+:;?,/=$&%'
-    encoded_text = urllib.parse.quote(text, safe=safe_characters)
-
-    return encoded_text
-
-@handle_rest_errors
-def get_metric(object_type, app, tier, agenttype, node):
-    """fetches last known agent availability info from tier or node level."""
-    tier = urlencode_string(tier)
-    app = urlencode_string(app)
-    if DEBUG:
-        print(f"        --- Begin get_metric({object_type},{app},{tier},{agenttype},{node})")
-
-    if object_type == "node":
-        print("        --- Querying node availability.")
-        if agenttype == "MACHINE_AGENT":
-            metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CIndividual%20Nodes%7C" + node + "%7CAgent%7CMachine%7CAvailability"
-        else:
-            metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CIndividual%20Nodes%7C" + node + "%7CAgent%7CApp%7CAvailability"
-    
-    elif object_type == "tier":
-        print("        --- Querying tier availability.")
-        metric_path = "Application%20Infrastructure%20Performance%7C" + tier + "%7CAgent%7CApp%7CAvailability"
-        
-    # If the machine agents were assigned a tier, the tier reads as an app agent. The availability data would be here instead
-    # metric_path = "Application%20Infrastructure%20Performance%7C" + tier_name + "%7CAgent%7CMachine%7CAvailability"
-    # future enhancement will reflect the number and last seen for machine agent tiers.
-
-    metric_url = BASE_URL + "/controller/rest/applications/" + app + "/metric-data?metric-path=" + metric_path + "&time-range-type=BEFORE_NOW&duration-in-mins=" + str(METRIC_DURATION_MINS) + "&rollup=" + METRIC_ROLLUP + "&output=json"
-                                
-    #get metric data
-    if DEBUG:
-        print("        --- metric url: " + metric_url)
-
-    metric_response = requests.get(
-        metric_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-
-    return metric_response
-
-def handle_metric_response(metric_data, metric_data_status):
-    """Processes returned metric JSON data"""
-    if DEBUG:
-        print("        --- handle_metric_response() - Handling metric data...")
-        print(f"        --- handle_metric_response() - metric_data: {metric_data}")
-        print(f"        --- handle_metric_response() - metric_data type: {type(metric_data)}")
-        print(f"        --- handle_metric_response() - metric_data_status: {metric_data_status}")
-
-    if metric_data_status == "valid":
-        if metric_data == []:
-            dt = "METRIC DATA NOT FOUND IN TIME RANGE"
-            print(dt)
-            return dt, metric_data_status
-        if metric_data[-1]['metricName'] == "METRIC DATA NOT FOUND":
-            dt = "METRIC DATA NOT FOUND IN TIME RANGE"
-            print(dt)
-            return dt, metric_data_status
-        elif metric_data[-1]['metricValues'][-1]['startTimeInMillis']:
-            if DEBUG:
-                print("        --- Performing datetime calculation on metric data")
-            last_start_time_millis = metric_data[-1]['metricValues'][-1]['startTimeInMillis']
-            if DEBUG:
-                print(f"            --- startTimeInMillis: {last_start_time_millis}")
-            #convert EPOCH to human readable datetime - we have to divide by 1000 because we show EPOCH in ms not seconds
-            if DEBUG:
-                print("            --- Converting EPOCH to datetime")
-            epoch = (last_start_time_millis/1000)
-            dt = datetime.datetime.fromtimestamp(epoch)
-            value = metric_data[-1]['metricValues'][-1]['current']
-            if DEBUG:
-                print(f"            --- dt: {dt} value: {value}")
-            return dt, value
-
-    elif metric_data_status == "empty":
-        dt = "EMPTY RESPONSE"
-        return dt, metric_data_status
-    
-    elif metric_data_status == "error":
-        dt = "ERROR"
-        return dt, metric_data_status
-    
-    elif metric_data == []:
-        dt = "EMPTY RESPONSE"
-        return dt, metric_data_status
-
-def validate_json(response):
-    """validation function to parse into JSON and catch empty sets returned from our API requests"""
-    if DEBUG:
-        print("        --- validate_json()")
-    if not response:
-        #this state is NOT always an error. Sometimes there are old tiers with no nodes anymore. Same for apps.
-        if DEBUG:
-            print("        ---- No response object was found.")
-        return [], "empty"
-
-    try:
-        if DEBUG:
-            print(f"        --- validate_json() - incoming response type:: {type(response)}")
-            print(f"        --- validate_json() - incoming response:{response}")
-        if not isinstance(response, requests.Response):
-            if DEBUG:
-                print(f"        --- validate_json() - length: {len(response)}") 
-                print("        --- validate_json() - unpacking response")
-            #unpack response
-            data, data_status = response
-            
-            #pass error and exceptions from the response along to the main code
-            if data_status == "error":
-                return data, data_status
-            else:
-                data = data.json()
-                if DEBUG:
-                    print(f"        --- validate_json() - data: {data} data_status: {data_status}")
-                return data, data_status
-        else:
-            # parse the request object into a json object and its status
-            json_data = response.json()
-
-            if DEBUG:
-                print(f"        --- validate_json() - data: {json_data}")
-                print(f"        --- validate_json() - json_data type: {type(json_data)}")  
-
-            # check for empty JSON object
-            if not json_data:
-                if DEBUG:
-                    print("\n            ---- The resulting JSON object judged as empty")
-                    print(f"            ---- data.text {data.text} , json_data {json_data}")
-                return None, "empty"
-
-            return json_data, "valid"
-
-    except json.JSONDecodeError:
-        # The data is not valid JSON.
-        if DEBUG:
-            print("The data is not valid JSON.")
-        return None, "error"
-
-@handle_rest_errors
-def get_applications():
-    """Get a list of all applications"""
-    print("--- Fetching applications...")
-    
-    if not is_token_valid():
-        authenticate("reauth")
-
-    if application_id:
-        #chosen when user supplied an app id in the config
-        applications_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "?output=json"
-        if DEBUG:
-            print("--- from "+applications_url)
-    else:
-        applications_url = BASE_URL + "/controller/rest/applications?output=json"
-        if DEBUG:
-            print("--- from "+applications_url)
-    
-    applications_response = requests.get(
-        applications_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-
-    if DEBUG:
-        print(applications_response.text)
-    return applications_response
-
-@handle_rest_errors
-def get_tiers(application_id):
-    """Gets the tiers in the application"""
-    if not is_token_valid():
-        authenticate("reauth")
-    
-    tiers_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/tiers?output=json"
-    
-    if DEBUG:
-        print("    --- Fetching tiers from: "+ tiers_url)
-    else:
-        print("    --- Fetching tiers...")
-
-    tiers_response = requests.get(
-        tiers_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-    if DEBUG:
-        print(f"    --- get_tiers response: {tiers_response.text}")
-
-    return tiers_response
-
-@handle_rest_errors
-def get_nodes(application_id, tier_id):
-    """Gets the nodes in a tier"""
-    if not is_token_valid():
-        authenticate("reauth")
-
-    nodes_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/tiers/" + str(tier_id) + "/nodes?output=json"
-    if DEBUG:
-        print(f"        --- Fetching node data from {nodes_url}.")
-    else:
-        print("        --- Fetching nodes from tier.")
-
-    nodes_response = requests.get(
-        nodes_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-
-    return nodes_response
-
-@handle_rest_errors
-def get_snapshots(application_id):
-    if not is_token_valid():
-        authenticate("reauth")
-
-    snapshots_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/request-snapshots?time-range-type=BEFORE_NOW&duration-in-mins=" + str(METRIC_DURATION_MINS) + "&first-in-chain=true&maximum-results=1000000&output=json"
-
-    if DEBUG:
-        print("    --- Fetching snapshots from: "+ snapshots_url)
-    else:
-        print("    --- Fetching snapshots...")
-
-    snapshots_response = requests.get(
-        snapshots_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-    #if DEBUG:
-    #    print(f"    --- get_snapshots response: {snapshots_response.text}")
-
-    return snapshots_response
-
-#@handle_rest_errors
-def get_bts(application_id): 
-    '''retrieves business transactions list from the application'''
-    
-    if not is_token_valid():
-        authenticate("reauth")
-
-    bts_url = BASE_URL + "/controller/rest/applications/" + str(application_id) + "/business-transactions"
-
-    if DEBUG:
-        print("    --- Fetching bts from: "+ bts_url)
-    else:
-        print("    --- Fetching bts...")
-
-    bts_response = requests.get(
-        bts_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-    #if DEBUG:
-    #    print(f"    --- get_bts response: {bts_response.text}")
-
-    #convert the XML to JSON
-    xml_data = bts_response.text
-
-    # Convert XML to an ordered dictionary
-    dict_data = xmltodict.parse(xml_data)
-    
-    #if DEBUG:
-    #    print("    --- BTs output:")
-    #    print(json.dumps(dict_data, indent=4)) 
-    
-    # Create the in-memory map
-    transaction_name_map = {}
-    
-    # Extract data and populate the map
-    for business_transaction in dict_data["business-transactions"]["business-transaction"]:
-        transaction_id = int(business_transaction["id"])  # Now 'id' is  accessed directly
-        transaction_name = business_transaction["name"]
-        entry_point_type = business_transaction.get("entryPointType")
-        tier_name = business_transaction.get("tierName")
-
-        transaction_name_map[transaction_id] = {
-            "name": transaction_name,
-            "entryPointType": entry_point_type,
-            "tierName": tier_name
-        }
-    
-    return transaction_name_map
-
 @handle_rest_errors
-def get_servers():
-    '''Get a list of all servers'''
+def get_servers(offset=None):
+    '''Get a list of all servers, or one page of SIM_PAGE_SIZE servers starting at offset'''
     servers_url = BASE_URL + "/controller/sim/v2/user/machines"
+    if offset is not None:
+        servers_url += f"?offset={offset}&limit={SIM_PAGE_SIZE}"
     if DEBUG:
-        print(f"    --- Retrieving Servers from {servers_url}")
-    else:
-        print("    --- Retrieving Servers...")
+        log.debug(f"    --- Retrieving Servers from {servers_url}")
               
-    servers_response = requests.get(
-        servers_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-
-    if DEBUG:
-        servers_data = servers_response.json()
-        servers_data_count = (len(servers_data))
-        print("servers_data length: " + str((servers_data_count)))
+    # streamed - the list can run to hundreds of MB on big container estates, parse it with iter_json_array()
+    servers_response = controller_get(servers_url, stream=True)
 
     return servers_response
 
-@handle_rest_errors
-def get_healthRules(application_id):
-    '''retrieves health rules from application(s)'''
-
-    if not is_token_valid():
-        authenticate("reauth")
-
-    healthRules_url = BASE_URL + "/controller/alerting/rest/v1/applications/" + str(application_id) + "/health-rules"
-
-    if DEBUG:
-        print(f"    --- Fetching health rules from: {healthRules_url}")
-    else:
-        print("    --- Fetching health rules...")
-
-    healthRules_response = requests.get(
-        healthRules_url,
-        headers = __session__.headers,
-        verify = VERIFY_SSL
-    )
-    if DEBUG:
-        print(f"    --- get_healthRules response: {healthRules_response.text}")
-
-    return healthRules_response    
-
-#--- MAIN
-authenticate("initial")
-
-servers_response = get_servers()
-servers, servers_status = validate_json(servers_response)
-
-# Open the output CSV file for writing
-print("Opening CSV file " + OUTPUT_CSV_FILE + " for writing...")
-with open(OUTPUT_CSV_FILE, "w") as csvfile:
-    csv_writer = csv.writer(csvfile)
-    csv_writer.writerow(["hierarchy", "hostId", "name", "namespace", "podName", "containerName", "containerImage", "containerCreated", "containerStarted", "tags", "memory", "volumes", "cpus", "machineInfo", "agentVersion", "simEnabled", "type", "DMM", "historical"])
-
-    # Iterate over each server
-    print("Iterating over each server to fetch info...")
-    
-    for server in servers:
-        '''
-        server = {
-            "agentConfig": {
-                "rawConfig": {
-                    "_agentRegistrationRequestConfig": {
-                        "agentVersion": "4.5.16.0",
-                        "autoRegisterAgent": true,
-                        "installDirectory": "",
-                        "jvmInfo": "",
-                        "machineInfo": "os.name=linux|os.arch=amd64|os.version=unknown"
-                    },
-                    "_agentRegistrationSupplementalConfig": {
-                        "containerType": "NON_APM",
-                        "hostName": "catqa3livelsi-app-5c44df898d-cmhdc",
-                        "hostSimMachineId": 1183832,
-                        "simMachineType": "CONTAINER"
-                    },
-                    "_features": {
-                        "features": [
-                            "basic",
-                            "sim"
-                        ]
-                    },
-                    "_machineInstanceRegistrationRequestConfig": {
-                        "forceMachineInstanceRegistration": true
-                    }
+def server_row(server):
+    """builds the CSV row for a Server"""
+    # each server in the machines list looks like this, Server.from_json() keeps the parts we report on
+    '''
+    server = {
+        "agentConfig": {
+            "rawConfig": {
+                "_agentRegistrationRequestConfig": {
+                    "agentVersion": "4.5.16.0",
+                    "autoRegisterAgent": true,
+                    "installDirectory": "",
+                    "jvmInfo": "",
+                    "machineInfo": "os.name=linux|os.arch=amd64|os.version=unknown"
+                },
+                "_agentRegistrationSupplementalConfig": {
+                    "containerType": "NON_APM",
+                    "hostName": "catqa3livelsi-app-5c44df898d-cmhdc",
+                    "hostSimMachineId": 1183832,
+                    "simMachineType": "CONTAINER"
+                },
+                "_features": {
+                    "features": [
+                        "basic",
+                        "sim"
+                    ]
+                },
+                "_machineInstanceRegistrationRequestConfig": {
+                    "forceMachineInstanceRegistration": true
                 }
-            },
-            "controllerConfig": {
-                "rawConfig": {
-                    "_agentRegistrationRequestConfig": {
-                        "agentVersion": "4.5.16.0",
-                        "autoRegisterAgent": true,
-                        "installDirectory": "",
-                        "jvmInfo": "",
-                        "machineInfo": "os.name=linux|os.arch=amd64|os.version=unknown"
-                    },
-                    "_agentRegistrationSupplementalConfig": {
-                        "containerType": "APM",
-                        "historical": false,
-                        "hostName": "catqa3livelsi-app-5c44df898d-cmhdc",
-                        "hostSimMachineId": 1183832,
-                        "simMachineType": "CONTAINER"
-                    },
-                    "_features": {
-                        "features": [
-                            "sim"
-                        ],
-                        "reason": {
-                            "code": "",
-                            "message": ""
-                        }
-                    },
-                    "_machineInstanceRegistrationRequestConfig": {
-                        "forceMachineInstanceRegistration": true
+            }
+        },
+        "controllerConfig": {
+            "rawConfig": {
+                "_agentRegistrationRequestConfig": {
+                    "agentVersion": "4.5.16.0",
+                    "autoRegisterAgent": true,
+                    "installDirectory": "",
+                    "jvmInfo": "",
+                    "machineInfo": "os.name=linux|os.arch=amd64|os.version=unknown"
+                },
+                "_agentRegistrationSupplementalConfig": {
+                    "containerType": "APM",
+                    "historical": false,
+                    "hostName": "catqa3livelsi-app-5c44df898d-cmhdc",
+                    "hostSimMachineId": 1183832,
+                    "simMachineType": "CONTAINER"
+                },
+                "_features": {
+                    "features": [
+                        "sim"
+                    ],
+                    "reason": {
+                        "code": "",
+                        "message": ""
                     }
+                },
+                "_machineInstanceRegistrationRequestConfig": {
+                    "forceMachineInstanceRegistration": true
                 }
-            },
-            "cpus": [],
-            "dynamicMonitoringMode": "KPI",
-            "hierarchy": [
-                "Containers",
-                "LSI"
-            ],
-            "historical": false,
-            "hostId": "85af50289777",
-            "id": 1222683,
-            "memory": {},
-            "name": "85af50289777",
-            "networkInterfaces": [],
-            "properties": {
-                "AppDynamics|Machine Type": "NON_CONTAINER_MACHINE_AGENT",
-                "Container|Created At": "2024-05-20T14:21:39Z",
-                "Container|Hostname": "85af50289777",
-                "Container|Id": "85af50289777",
-                "Container|Image|Id": "040055090629.dkr.ecr.us-east-2.amazonaws.com/ecomm/commerce/lsi-app@sha256:6cdb04f2a52353536405facf04adf9fcd496f04b132de579378cd9e0b8cea7e4",
-                "Container|Image|Name": "040055090629.dkr.ecr.us-east-2.amazonaws.com/ecomm/commerce/lsi-app:main_20240517.2",
-                "Container|K8S|Namespace": "qa3",
-                "Container|K8S|PodName": "catqa3livelsi-app-5c44df898d-cmhdc",
-                "Container|Name": "lsi-app",
-                "Container|Started At": "2024-05-20T14:21:48Z"
-            },
-            "simEnabled": true,
-            "simNodeId": 95291051,
-            "tags": {},
-            "type": "CONTAINER",
-            "volumes": []
+            }
+        },
+        "cpus": [],
+        "dynamicMonitoringMode": "KPI",
+        "hierarchy": [
+            "Containers",
+            "LSI"
+        ],
+        "historical": false,
+        "hostId": "85af50289777",
+        "id": 1222683,
+        "memory": {},
+        "name": "85af50289777",
+        "networkInterfaces": [],
+        "properties": {
+            "AppDynamics|Machine Type": "NON_CONTAINER_MACHINE_AGENT",
+            "Container|Created At": "2024-05-20T14:21:39Z",
+            "Container|Hostname": "85af50289777",
+            "Container|Id": "85af50289777",
+            "Container|Image|Id": "040055090629.dkr.ecr.us-east-2.amazonaws.com/ecomm/commerce/lsi-app@sha256:6cdb04f2a52353536405facf04adf9fcd496f04b132de579378cd9e0b8cea7e4",
+            "Container|Image|Name": "040055090629.dkr.ecr.us-east-2.amazonaws.com/ecomm/commerce/lsi-app:main_20240517.2",
+            "Container|K8S|Namespace": "qa3",
+            "Container|K8S|PodName": "catqa3livelsi-app-5c44df898d-cmhdc",
+            "Container|Name": "lsi-app",
+            "Container|Started At": "2024-05-20T14:21:48Z"
+        },
+        "simEnabled": true,
+        "simNodeId": 95291051,
+        "tags": {},
+        "type": "CONTAINER",
+        "volumes": []
+    }
+    '''
+
+    namespace = podName = containerName = containerImage = containerCreated = containerStarted = ""
+
+    if (server.type == "CONTAINER" and not server.historical):
+        container = {
+            "Container|K8S|Namespace": server.namespace,
+            "Container|K8S|PodName": server.pod_name,
+            "Container|Name": server.container_name,
+            "Container|Image|Name": server.container_image,
+            "Container|Created At": server.container_created,
+            "Container|Started At": server.container_started
         }
-        '''
-
-        namespace = podName = containerName = containerImage = containerCreated = containerStarted = ""
-        machineInfo = server["agentConfig"]["rawConfig"]["_agentRegistrationRequestConfig"]["machineInfo"]
-        agentVersion = server["agentConfig"]["rawConfig"]["_agentRegistrationRequestConfig"]["agentVersion"]
-
-        if (server["type"] == "CONTAINER" and not server["historical"]):
-            '''
-            # use for debugging - outputs the server entity
-            formatted_json = json.dumps(server, indent=4, sort_keys=True)
-            print(formatted_json)
-            input("Press any key to continue...")
-            '''
-            if ("Container|K8S|Namespace" in server["properties"]):
-                namespace = server["properties"]["Container|K8S|Namespace"]
-            else:
-                # Handle the case where the key does not exist
-                print("The key 'Container|K8S|Namespace' does not exist in the dictionary")
-
-            if ("Container|K8S|PodName" in server["properties"]):
-                podName = server["properties"]["Container|K8S|PodName"]
-            else:
-                # Handle the case where the key does not exist
-                print("The key 'Container|K8S|PodName' does not exist in the dictionary")
-            
-            if ("Container|Name" in server["properties"]):
-                containerName = server["properties"]["Container|Name"]
-            else:
+        for key, value in container.items():
+            if value is None:
                 # Handle the case where the key does not exist
-                print("The key 'containerName' does not exist in the dictionary")
-            
-            if ("Container|Image|Name" in server["properties"]):
-                containerImage = server["properties"]["Container|Image|Name"]
+                __missing_keys__[key] += 1
+
+        namespace, podName, containerName, containerImage, containerCreated, containerStarted = (value or "" for value in container.values())
+
+    return [server.hierarchy, server.host_id, server.name, namespace, podName, containerName, containerImage, containerCreated, containerStarted, server.tags, server.memory, server.volumes, server.cpus, server.machine_info, server.agent_version, server.sim_enabled, server.type, server.dynamic_monitoring_mode, server.historical]
+
+def stream_server_page(offset, loop, page_queue):
+    """runs on a worker thread - streams one page of servers, or the whole list when offset is None, and hands them
+    to the writer in batches through page_queue. The queue is bounded so a slow writer holds the download back
+    instead of servers piling up in memory. Returns how many servers were read and the status"""
+    def put(item):
+        # never wait on the loop for good - once the crawl has stopped the loop is not coming back to take the item
+        if __stopping__.is_set():
+            raise concurrent.futures.CancelledError("the crawl was stopped")
+        queued = asyncio.run_coroutine_threadsafe(page_queue.put(item), loop)
+        while True:
+            try:
+                return queued.result(timeout=1)
+            except concurrent.futures.TimeoutError:
+                if __stopping__.is_set():
+                    queued.cancel()
+                    raise concurrent.futures.CancelledError("the crawl was stopped")
+
+    servers_response, servers_status = get_servers(offset)
+    server_count = 0
+    if servers_status == "valid":
+        batch = []
+        try:
+            for server in iter_json_array(iter_response_chunks(servers_response)):
+                batch.append(Server.from_json(server))
+                if len(batch) == SERVER_BATCH_SIZE:
+                    put((batch, "valid"))
+                    server_count += len(batch)
+                    batch = []
+            put((batch, "valid"))
+            server_count += len(batch)
+        except (ValueError, KeyError, TypeError, *appd_core.HTTP_REQUEST_ERRORS) as err:
+            servers_status = "error"
+            put((f"could not read the server list: {err}", "error"))
+    else:
+        put((servers_response, "error"))
+
+    put(None)
+    return server_count, servers_status
+
+async def fetch_servers(pages, pool):
+    """requests pages of servers, keeping CONCURRENT_WORKERS of them in flight, and queues them in order for writing"""
+    loop = asyncio.get_running_loop()
+    in_flight = collections.deque()
+    offset = None if not SIM_PAGE_SIZE else 0
+    last_page = False
+
+    while in_flight or not last_page:
+        while not last_page and len(in_flight) < (CONCURRENT_WORKERS if SIM_PAGE_SIZE else 1):
+            page_queue = asyncio.Queue(maxsize=2)
+            await pages.put(page_queue)
+            in_flight.append(loop.run_in_executor(pool, stream_server_page, offset, loop, page_queue))
+            if not SIM_PAGE_SIZE:
+                last_page = True
             else:
-                # Handle the case where the key does not exist
-                print("The key 'Container|Image|Name' does not exist in the dictionary")
+                offset += SIM_PAGE_SIZE
+
+        server_count, servers_status = await in_flight.popleft()
+        # a short page is the end of the list - anything still in flight is past it and comes back empty. A page
+        # longer than SIM_PAGE_SIZE means the controller ignored the paging and sent everything
+        if servers_status != "valid" or server_count != SIM_PAGE_SIZE:
+            last_page = True
+
+    await pages.put(None)
+
+async def write_servers(pages, exporter, store=None):
+    """writes out the servers of each page, in order, as they are parsed while the next pages are still downloading"""
+    server_count = 0
+    servers_status = "empty"
+    whole_list = False
+
+    while (page_queue := await pages.get()) is not None:
+        page_count = 0
+        while (batch := await page_queue.get()) is not None:
+            servers, page_status = batch
+            if whole_list:
+                # keep draining so the worker can finish, these are repeats of the list already written
+                continue
+            if page_status == "error":
+                log.error(f"Error retrieving servers: {servers}")
+                servers_status = "error"
+                continue
+            if servers_status != "error":
+                servers_status = "valid"
+            rows = [server_row(server) for server in servers]
+            exporter.write_rows(rows)
+            if store:
+                store.write_rows(rows)
+            page_count += len(servers)
+            server_count += len(servers)
+            __progress__.advance(len(servers))
+            if DEBUG:
+                log.debug(f"    --- {server_count} servers written")
 
-            if ("Container|Created At" in server["properties"]):
-                containerCreated = server["properties"]["Container|Created At"]
-            else:
-                print("The key 'Container|Created At' does not exist in the dictionary")
+        if SIM_PAGE_SIZE and page_count > SIM_PAGE_SIZE and not whole_list:
+            log.warning("The controller does not support paging the server list, set SIM_PAGE_SIZE = 0.")
+            whole_list = True
 
-            if ("Container|Started At" in server["properties"]):
-                containerStarted = server["properties"]["Container|Started At"]
-            else:
-                print("The key 'Container|Started At' does not exist in the dictionary")
-                
-        csv_writer.writerow([server["hierarchy"], server["hostId"], server["name"], namespace, podName, containerName, containerImage, containerCreated, containerStarted, server["tags"], server["memory"], server["volumes"], server["cpus"], machineInfo, agentVersion, server["simEnabled"], server["type"], server["dynamicMonitoringMode"], server["historical"]])
\ No newline at end of file
+    return server_count, servers_status
+
+async def crawl_servers(exporter, pool, store=None):
+    """fetches the servers and writes them out at the same time - the requests run on worker threads of pool over the
+    shared session so they keep its connection pool, rate limiting, retries and token refresh"""
+    pages = asyncio.Queue()
+    try:
+        _, (server_count, servers_status) = await asyncio.gather(fetch_servers(pages, pool), write_servers(pages, exporter, store))
+    except BaseException:
+        # a failed write or Ctrl-C - the workers must not wait on this loop any more, it is about to close
+        __stopping__.set()
+        raise
+    return server_count, servers_status
+
+def run_crawl(exporter, store=None):
+    """runs crawl_servers() on an event loop, with its worker threads outside the loop. If the crawl fails or is
+    interrupted crawl_servers() tells the workers to stop, and the pages not started yet are dropped before waiting
+    for the rest"""
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=CONCURRENT_WORKERS)
+    try:
+        return asyncio.run(crawl_servers(exporter, pool, store))
+    finally:
+        __stopping__.set()
+        pool.shutdown(wait=True, cancel_futures=True)
+
+# the report's columns - lists and dicts stay nested in the JSON Lines and Parquet output, in the shapes given here
+SERVER_COLUMNS = [("hierarchy", [str]), ("hostId", str), ("name", str), ("namespace", str), ("podName", str), ("containerName", str), ("containerImage", str), ("containerCreated", str), ("containerStarted", str),
+                  ("tags", {str: [str]}), ("memory", {str: {"sizeMb": int}}), ("volumes", [{"mountPoint": str, "partition": str, "sizeMb": int}]),
+                  ("cpus", [{"cores": int, "logicalCores": int, "speedMhz": int, "vendor": str}]), ("machineInfo", str), ("agentVersion", str), ("simEnabled", bool), ("type", str), ("DMM", str), ("historical", bool)]
+
+#--- MAIN
+# run through appd, __prog__ is the command it was run as, e.g. "appd apps"
+parser = argparse.ArgumentParser(prog=globals().get("__prog__"), description="Reports on every server and container known to Server Visibility in an AppDynamics controller.")
+parser.add_argument("--base-url", help=f"controller URL (default: {BASE_URL})")
+parser.add_argument("--account", help=f"controller account name (default: {APPDYNAMICS_ACCOUNT_NAME})")
+parser.add_argument("--api-client", help="API client name (default: APPDYNAMICS_API_CLIENT)")
+parser.add_argument("--api-secret", default=os.environ.get("APPDYNAMICS_API_CLIENT_SECRET"), help="API client secret (default: the APPDYNAMICS_API_CLIENT_SECRET environment variable, then APPDYNAMICS_API_CLIENT_SECRET)")
+parser.add_argument("--output", help=f"file to write (default: {OUTPUT_CSV_FILE}, with the extension of the format)")
+parser.add_argument("--format", default=OUTPUT_FORMAT, choices=EXPORTERS, help="output format (default: %(default)s)")
+parser.add_argument("--db", default=INVENTORY_DB, help="also add the run to this SQLite inventory database")
+parser.add_argument("--workers", type=int, default=CONCURRENT_WORKERS, help="worker threads querying the controller at once (default: %(default)s)")
+parser.add_argument("--metrics-json", help="write per endpoint request counts, errors, bytes and latencies to this JSON file")
+parser.add_argument("--metrics-prom", help="write the same request statistics to this file in the Prometheus text format")
+parser.add_argument("--log-level", default=LOG_LEVEL, choices=["DEBUG", "INFO", "WARNING", "ERROR"], help="console messages to show (default: %(default)s)")
+parser.add_argument("--log-file", help="also write the messages to this file, INFO and up or everything with --log-level DEBUG")
+args = parser.parse_args()
+setup_logging(args.log_level, args.log_file)
+# the detailed per query messages are only built when something will show them
+DEBUG = log.isEnabledFor(logging.DEBUG)
+if args.account and args.account != APPDYNAMICS_ACCOUNT_NAME:
+    # the default file names and SaaS controller URL are built from the account name, they follow it
+    OUTPUT_CSV_FILE = OUTPUT_CSV_FILE.replace(APPDYNAMICS_ACCOUNT_NAME, args.account, 1)
+    BASE_URL = BASE_URL.replace("//" + APPDYNAMICS_ACCOUNT_NAME + ".", "//" + args.account + ".", 1)
+    APPDYNAMICS_ACCOUNT_NAME = args.account
+BASE_URL = (args.base_url or BASE_URL).rstrip("/")
+APPDYNAMICS_API_CLIENT = args.api_client or APPDYNAMICS_API_CLIENT
+APPDYNAMICS_API_CLIENT_SECRET = args.api_secret or APPDYNAMICS_API_CLIENT_SECRET
+OUTPUT_FORMAT = args.format
+INVENTORY_DB = args.db
+if args.workers < 1:
+    parser.error("--workers must be at least 1")
+if args.workers != CONCURRENT_WORKERS:
+    # the connection pool grows with the workers so none of them waits for a connection
+    CONCURRENT_WORKERS = args.workers
+    HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, CONCURRENT_WORKERS)
+if args.output:
+    OUTPUT_CSV_FILE = args.output
+else:
+    OUTPUT_CSV_FILE = os.path.splitext(OUTPUT_CSV_FILE)[0] + EXPORTERS[OUTPUT_FORMAT].extension
+
+appd_core.configure(globals())
+appd_core.login()
+
+# Open the output file for writing
+log.info(f"Opening {OUTPUT_FORMAT} file " + OUTPUT_CSV_FILE + " for writing...")
+store = InventoryStore(INVENTORY_DB, "servers", "servers", SERVER_COLUMNS, [("host_id", "run_id")]) if INVENTORY_DB else contextlib.nullcontext()
+with EXPORTERS[OUTPUT_FORMAT](OUTPUT_CSV_FILE, SERVER_COLUMNS) as exporter, store:
+    # Iterate over each server
+    log.info("Iterating over each server to fetch info...")
+    __progress__ = Progress("servers")
+    server_count, servers_status = run_crawl(exporter, store if INVENTORY_DB else None)
+
+__progress__.finish()
+for key, count in __missing_keys__.most_common():
+    log.warning(f"'{key}' missing on {count} containers")
+log.info(f"{server_count} servers written to {OUTPUT_CSV_FILE}")
+print_request_stats()
+write_request_stats("servers", args.metrics_json, args.metrics_prom)
+if servers_status == "error":
+    sys.exit(1)
@@ -0,0 +1,60 @@
+# One command for every report: appd apps, appd servers, appd bts, appd healthrules and appd snapshots run
+# appd-checkup.py or appd-servers-checkup.py with the matching report, in the same Python process. Any other option
+# is passed on to the script, so `appd apps --help` lists them all. appd diff and appd fleet run the other tools.
+# install with `pip install .`, or `pip install -e .` to keep editing the configuration at the top of the scripts
+# for questions / help contact Robert Vandervoort - rvander2@cisco.com
+# CHEERS!
+
+import os
+import sys
+import runpy
+import argparse
+import importlib.metadata
+
+# the scripts sit next to this file in a checkout or an editable install
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# each command, with the script it runs, the arguments it adds in front of the user's, and its description
+COMMANDS = {
+    "apps": ("appd-checkup.py", ["--report", "nodes"], "every application, tier and node, with when each agent last reported"),
+    "servers": ("appd-servers-checkup.py", [], "every server and container known to Server Visibility"),
+    "bts": ("appd-checkup.py", ["--report", "bts"], "every business transaction of every application"),
+    "healthrules": ("appd-checkup.py", ["--report", "healthrules"], "every health rule of every application"),
+    "snapshots": ("appd-checkup.py", ["--report", "snapshots"], "request snapshot counts per business transaction"),
+    "diff": ("appd-checkup-diff.py", [], "what changed between two apps reports"),
+    "fleet": ("appd-fleet.py", [], "run apps and servers against a list of controllers in parallel"),
+}
+
+def script_path(script):
+    """where a script is - next to this file, or wherever pip installed the package's data files, which depends on
+    the scheme it used (--user, a venv, a prefix). The installed location is read from the package's RECORD"""
+    path = os.path.join(HERE, script)
+    if os.path.exists(path):
+        return path
+    try:
+        installed = importlib.metadata.files("appd-checkup") or []
+    except importlib.metadata.PackageNotFoundError:
+        installed = []
+    for file in installed:
+        if file.name == script:
+            return str(file.locate().resolve())
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="appd", description="Reports on the state of an AppDynamics deployment.",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog="commands:\n" + "\n".join(f"  {name:<13}{description}" for name, (_, _, description) in COMMANDS.items())
+                                            + "\n\nrun appd <command> --help for the options of a command")
+    parser.add_argument("command", choices=COMMANDS, metavar="command", help="the report to run, see below")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help="options for the command")
+    args = parser.parse_args(argv)
+
+    script, report_args, _ = COMMANDS[args.command]
+    # the script reads its command line from sys.argv and runs as if it had been started on its own. Only the script
+    # that is run gets imported, along with whatever it needs. run_path points sys.argv[0] at the script while it
+    # runs, so the script is told in __prog__ what to call itself in its usage and errors
+    sys.argv = [f"appd {args.command}"] + report_args + args.args
+    runpy.run_path(script_path(script), init_globals={"__prog__": f"appd {args.command}"}, run_name="__main__")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,990 @@
+# The parts appd-checkup.py and appd-servers-checkup.py share - logging in and keeping the OAuth token fresh, the pooled
+# HTTP session, rate limiting and retries, the request statistics, logging and progress, the streaming parsers, the
+# inventory records and the exporters. Each script keeps its own configuration section and hands its settings over
+# with configure() once its command line has been read.
+# for questions / help contact Robert Vandervoort - rvander2@cisco.com
+# CHEERS!
+
+import os
+import sys
+import json
+import re
+import sqlite3
+import csv
+import datetime
+import time
+import codecs
+import random
+import threading
+import logging
+import email.utils
+import urllib.parse
+from dataclasses import dataclass
+import requests
+import requests.adapters
+
+#--- SETTINGS
+"""
+These are only defaults. The scripts set them from their own configuration sections and command lines through
+configure(), see there for what each one does.
+"""
+DEBUG = False
+PROGRESS_INTERVAL_SECS = 10
+APPDYNAMICS_ACCOUNT_NAME = "account"
+APPDYNAMICS_API_CLIENT = "api_client_name"
+APPDYNAMICS_API_CLIENT_SECRET = "secret"
+BASE_URL = "https://"+APPDYNAMICS_ACCOUNT_NAME+".saas.appdynamics.com"
+VERIFY_SSL = True
+HTTP_POOL_SIZE = 1
+HTTP2 = False
+MAX_REQUESTS_PER_SECOND = 50
+MAX_IN_FLIGHT_REQUESTS = 20
+MAX_RETRIES = 5
+RETRY_BACKOFF_SECS = 1
+RETRY_BACKOFF_MAX_SECS = 60
+
+# the settings configure() takes from a script
+SETTINGS = ("DEBUG", "PROGRESS_INTERVAL_SECS", "APPDYNAMICS_ACCOUNT_NAME", "APPDYNAMICS_API_CLIENT", "APPDYNAMICS_API_CLIENT_SECRET",
+            "BASE_URL", "VERIFY_SSL", "HTTP_POOL_SIZE", "HTTP2", "MAX_REQUESTS_PER_SECOND", "MAX_IN_FLIGHT_REQUESTS", "MAX_RETRIES",
+            "RETRY_BACKOFF_SECS", "RETRY_BACKOFF_MAX_SECS")
+
+#exceptions raised by the HTTP client - build_session() adds the httpx equivalents when HTTP2 is on
+HTTP_STATUS_ERRORS = (requests.exceptions.HTTPError,)
+HTTP_CONNECTION_ERRORS = (requests.exceptions.ConnectionError,)
+HTTP_REQUEST_ERRORS = (requests.exceptions.RequestException,)
+HTTP_TIMEOUT_ERRORS = (requests.exceptions.Timeout,)
+
+#the shared session, built by login() - do not change this value
+__session__ = None
+
+#rate limiter state - do not change these values
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+__rate_lock__ = threading.Lock()
+__in_flight__ = threading.BoundedSemaphore(MAX_IN_FLIGHT_REQUESTS)
+__request_rate__ = MAX_REQUESTS_PER_SECOND
+__rate_tokens__ = 1.0
+__rate_updated__ = time.monotonic()
+
+#manages token expiration - do not change these values
+OAUTH_PATH = "/controller/api/oauth/access_token"
+last_token_fetch_time = ""
+token_expiration = 300
+expiration_buffer = 30
+# the background refresh never comes round sooner than this, however short lived the tokens are
+TOKEN_REFRESH_MIN_SECS = 5
+__token_lock__ = threading.Lock()
+__token_timer__ = None
+
+#request statistics per endpoint family - do not change these values
+ENDPOINT_FAMILIES = (
+    (OAUTH_PATH, "oauth"),
+    ("/metric-data", "metric-data"),
+    ("/sim/v2/user/machines", "sim machines"),
+    ("/health-rules", "health rules"),
+    ("/request-snapshots", "snapshots"),
+    ("/business-transactions", "business transactions"),
+    ("/nodes", "nodes"),
+    ("/tiers", "tiers"),
+    ("/applications", "applications"),
+)
+__stats_lock__ = threading.Lock()
+__endpoint_stats__ = {}
+# time spent in the last request on this thread, set by controller_get()
+__request_timing__ = threading.local()
+
+#logging - do not change this value
+log = logging.getLogger("appd-checkup")
+
+#---INVENTORY MODEL
+# compact records for what we read from the controller - built straight from the JSON with from_json() and passed
+# through every stage instead of the raw dicts. Slots keep a full inventory of tens of thousands of nodes small.
+@dataclass(slots=True)
+class Application:
+    id: int
+    name: str
+    description: str
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["name"], data.get("description") or "")
+
+@dataclass(slots=True)
+class Tier:
+    id: int
+    name: str
+    type: str
+    agent_type: str
+    node_count: int
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["name"], data.get("type"), data.get("agentType"), data.get("numberOfNodes"))
+
+@dataclass(slots=True)
+class Node:
+    id: int
+    name: str
+    machine_name: str
+    os_type: str
+    machine_agent_version: str
+    app_agent_version: str
+    agent_type: str
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data["name"], data.get("machineName"), data.get("machineOSType"), data.get("machineAgentVersion"), data.get("appAgentVersion"), data.get("agentType"))
+
+@dataclass(slots=True)
+class BusinessTransaction:
+    id: int
+    name: str
+    entry_point_type: str
+    tier_name: str
+    background: bool
+
+    @classmethod
+    def from_json(cls, data):
+        # the XML form of the list has every value as text
+        return cls(int(data["id"]), data["name"], data.get("entryPointType"), data.get("tierName"), data.get("background") in (True, "true"))
+
+@dataclass(slots=True)
+class HealthRule:
+    id: int
+    name: str
+    enabled: bool
+    affected_entity_type: str
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data["id"], data.get("name"), data.get("enabled"), data.get("affectedEntityType"))
+
+@dataclass(slots=True)
+class Server:
+    host_id: str
+    name: str
+    hierarchy: list
+    namespace: str
+    pod_name: str
+    container_name: str
+    container_image: str
+    container_created: str
+    container_started: str
+    tags: dict
+    memory: dict
+    volumes: list
+    cpus: list
+    machine_info: str
+    agent_version: str
+    sim_enabled: bool
+    type: str
+    dynamic_monitoring_mode: str
+    historical: bool
+
+    @classmethod
+    def from_json(cls, data):
+        """keeps just the fields the reports use, so the rest of the machine (agent and controller config, the other
+        properties and so on) can be freed as soon as it has been parsed. Missing container properties are None"""
+        registration = data["agentConfig"]["rawConfig"]["_agentRegistrationRequestConfig"]
+        properties = data["properties"]
+        return cls(
+            data["hostId"],
+            data["name"],
+            data["hierarchy"],
+            properties.get("Container|K8S|Namespace"),
+            properties.get("Container|K8S|PodName"),
+            properties.get("Container|Name"),
+            properties.get("Container|Image|Name"),
+            properties.get("Container|Created At"),
+            properties.get("Container|Started At"),
+            data["tags"],
+            data["memory"],
+            data["volumes"],
+            data["cpus"],
+            registration["machineInfo"],
+            registration["agentVersion"],
+            data["simEnabled"],
+            data["type"],
+            data["dynamicMonitoringMode"],
+            data["historical"]
+        )
+
+#---EXPORTERS
+# every report is written through one of these. They all take the report's columns as (name, type) pairs and rows as
+# lists in that order, and are used as context managers so the file is finished off properly however the run ends.
+def column_type(kind):
+    """the type of a column - a list or dict column can give the shape of its values instead, see ParquetExporter"""
+    return type(kind) if isinstance(kind, (list, dict)) else kind
+
+def column_value(kind, value):
+    """a cell as the typed formats want it - lists and dicts are kept as they are, anything else is converted to the
+    column's type"""
+    if value is None or column_type(kind) in (list, dict):
+        return value
+    return kind(value)
+
+class CsvExporter:
+    """writes rows to a CSV file, lists and dicts are written as their text"""
+    extension = ".csv"
+    resumable = True
+
+    def __init__(self, path, columns, append=False):
+        self.file = open(path, "a" if append else "w", newline='')
+        self.writer = csv.writer(self.file)
+        if not append:
+            self.writer.writerow([name for name, _ in columns])
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def tell(self):
+        """flushes what has been written so far and returns where the file ends"""
+        self.file.flush()
+        return self.file.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+class JsonLinesExporter:
+    """writes each row as a JSON object on a line of its own, keyed by column name"""
+    extension = ".jsonl"
+    resumable = True
+
+    def __init__(self, path, columns, append=False):
+        self.file = open(path, "a" if append else "w")
+        self.columns = columns
+
+    def write_rows(self, rows):
+        for row in rows:
+            record = {name: column_value(kind, value) for (name, kind), value in zip(self.columns, row)}
+            self.file.write(json.dumps(record, default=str) + "\n")
+
+    def tell(self):
+        """flushes what has been written so far and returns where the file ends"""
+        self.file.flush()
+        return self.file.tell()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+class ParquetExporter:
+    """streams rows into a Parquet file a row group at a time, so only the rows of the group being filled are held in
+    memory. Scalar columns get the column's type. List and dict columns give the shape of their values as their type -
+    [item] is a list of item, {str: value} a map from text to value, and {"field": type, ...} a struct whose fields
+    missing from a value are left null and whose other keys are dropped. Needs pyarrow"""
+    extension = ".parquet"
+    resumable = False
+    # rows held back and written out together as one row group
+    row_group_rows = 10000
+
+    def __init__(self, path, columns, append=False):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            log.error("Parquet output needs the pyarrow package - pip install pyarrow")
+            sys.exit(1)
+        self.pa = pyarrow
+        self.columns = columns
+        self.types = {str: pyarrow.string(), bool: pyarrow.bool_(), int: pyarrow.int64(), float: pyarrow.float64()}
+        self.schema = pyarrow.schema([(name, self.arrow_type(kind)) for name, kind in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.rows = []
+
+    def arrow_type(self, kind):
+        if isinstance(kind, list):
+            return self.pa.list_(self.arrow_type(kind[0]))
+        if isinstance(kind, dict):
+            if list(kind) == [str]:
+                return self.pa.map_(self.pa.string(), self.arrow_type(kind[str]))
+            return self.pa.struct([(name, self.arrow_type(field)) for name, field in kind.items()])
+        return self.types[kind]
+
+    def write_rows(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.row_group_rows:
+            self.flush()
+
+    def flush(self):
+        """converts the rows held back column by column and writes them out as a row group"""
+        rows, self.rows = self.rows, []
+        arrays = []
+        for index, ((name, kind), field) in enumerate(zip(self.columns, self.schema)):
+            try:
+                arrays.append(self.pa.array([column_value(kind, row[index]) for row in rows], type=field.type))
+            except (self.pa.ArrowInvalid, self.pa.ArrowTypeError) as error:
+                raise ValueError(f"The {name} column does not fit its Parquet type {field.type}: {error}") from error
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def tell(self):
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self.rows:
+                self.flush()
+        finally:
+            self.writer.close()
+
+class InventoryStore:
+    """keeps the rows of every run in a SQLite database, next to the runs table that says when each run happened, so
+    the history can be queried across runs. Columns are named after the report's, in snake case. Lists and dicts are
+    stored as JSON text. Each call to write_rows is inserted in a single transaction, and last_rowid follows the last
+    row written so a resumed run can drop what it wrote after its last checkpoint with truncate(). Pass the run_id of an
+    interrupted run to carry on with it rather than start another"""
+    types = {str: "TEXT", bool: "INTEGER", int: "INTEGER", float: "REAL", list: "TEXT", dict: "TEXT"}
+
+    def __init__(self, path, report, table, columns, indexes=(), run_id=None):
+        self.db = sqlite3.connect(path)
+        self.table = table
+        self.columns = columns
+        names = [self.column_name(name) for name, _ in columns]
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, report TEXT, account TEXT, started TEXT, finished TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS runs_report_started ON runs (report, started)")
+            self.db.execute(f"CREATE TABLE IF NOT EXISTS {table} (run_id INTEGER REFERENCES runs (id), "
+                            + ", ".join(f"{name} {self.types[column_type(kind)]}" for name, (_, kind) in zip(names, columns)) + ")")
+            self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_run ON {table} (run_id)")
+            for index in indexes:
+                self.db.execute(f"CREATE INDEX IF NOT EXISTS {table}_{'_'.join(index)} ON {table} ({', '.join(index)})")
+
+            run = None
+            if run_id is not None:
+                run = self.db.execute("SELECT id FROM runs WHERE id = ? AND report = ? AND finished IS NULL", (run_id, report)).fetchone()
+                if not run:
+                    log.warning(f"Run {run_id} is not an unfinished {report} run in {path}, adding a new run instead.")
+            if run:
+                self.run_id = run[0]
+            else:
+                self.run_id = self.db.execute("INSERT INTO runs (report, account, started) VALUES (?, ?, ?)",
+                                              (report, APPDYNAMICS_ACCOUNT_NAME, datetime.datetime.now().isoformat(sep=" ", timespec="seconds"))).lastrowid
+        self.insert = f"INSERT INTO {table} (run_id, {', '.join(names)}) VALUES (?{', ?' * len(names)})"
+        self.last_rowid = self.db.execute(f"SELECT coalesce(max(rowid), 0) FROM {table}").fetchone()[0]
+
+    @staticmethod
+    def column_name(name):
+        """hostId -> host_id, Last up count -> last_up_count"""
+        return re.sub(r"(?<=[a-z])(?=[A-Z])|\W+", "_", name).lower()
+
+    def value(self, kind, value):
+        if value is None or (value == "" and kind is not str):
+            return None
+        if column_type(kind) in (list, dict):
+            return json.dumps(value)
+        return column_value(kind, value)
+
+    def write_rows(self, rows):
+        with self.db:
+            self.db.executemany(self.insert, ([self.run_id] + [self.value(kind, value) for (_, kind), value in zip(self.columns, row)] for row in rows))
+            self.last_rowid = self.db.execute(f"SELECT coalesce(max(rowid), 0) FROM {self.table}").fetchone()[0]
+
+    def truncate(self, rowid):
+        """deletes the rows this run wrote after rowid"""
+        with self.db:
+            deleted = self.db.execute(f"DELETE FROM {self.table} WHERE run_id = ? AND rowid > ?", (self.run_id, rowid)).rowcount
+        self.last_rowid = rowid
+        return deleted
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            with self.db:
+                self.db.execute("UPDATE runs SET finished = ? WHERE id = ?", (datetime.datetime.now().isoformat(sep=" ", timespec="seconds"), self.run_id))
+        self.db.close()
+
+EXPORTERS = {"csv": CsvExporter, "jsonl": JsonLinesExporter, "parquet": ParquetExporter}
+
+#---FUNCTION DEFINITIONS
+def configure(settings):
+    """takes the settings named in SETTINGS from a script's globals, once its command line has been applied, and sets
+    the rate limiter up for them"""
+    global __in_flight__, __request_rate__
+    for name in SETTINGS:
+        if name in settings:
+            globals()[name] = settings[name]
+    __in_flight__ = threading.BoundedSemaphore(MAX_IN_FLIGHT_REQUESTS)
+    __request_rate__ = MAX_REQUESTS_PER_SECOND
+
+def login():
+    """builds the shared session and logs in with it, exits if the controller cannot be logged into"""
+    global __session__
+    __session__ = build_session()
+    authenticate("initial")
+
+def authenticate(state):
+    """get XCSRF token for use in this session"""
+    if state == "reauth":
+        log.info("Obtaining a fresh authentication token.")
+    if state == "initial":
+        log.info("Begin login.")
+    
+    if not connect(APPDYNAMICS_ACCOUNT_NAME, APPDYNAMICS_API_CLIENT, APPDYNAMICS_API_CLIENT_SECRET):
+        if state == "initial":
+            log.error("Please check your controller URL and try again.")
+            sys.exit(9)
+        log.warning("Token refresh failed, will try again on the next request.")
+    
+    return
+
+def is_token_valid():
+    """Checks if the access token is valid and not expired."""
+    if DEBUG:
+        log.debug("Checking token validity...")
+
+    if __session__ is None:
+        if DEBUG:
+            log.debug("__session__ not found or empty.")
+        return False
+
+    # Conservative buffer (e.g., 30 seconds before expiration), shrunk for tokens that only live a minute or so
+    if DEBUG:
+        log.debug(f"__session__: {__session__}")
+    return time.time() < (token_expiration + last_token_fetch_time - min(expiration_buffer, token_expiration / 4))
+
+def refresh_token(stale_token):
+    """replaces stale_token with a fresh one. Threads that queue up on the lock behind a refresh see the token has
+    already changed and return, so they share that one refresh instead of each fetching their own"""
+    with __token_lock__:
+        if __session__.headers.get("Authorization") != stale_token:
+            return
+        authenticate("reauth")
+
+def ensure_token():
+    """refreshes the token before a request if it is about to expire and the background refresh has not done it yet"""
+    if not is_token_valid():
+        refresh_token(__session__.headers.get("Authorization"))
+
+def schedule_token_refresh():
+    """refreshes the token in the background ahead of the expiry buffer, so requests never wait on it or see a 401"""
+    global __token_timer__
+    if __token_timer__:
+        __token_timer__.cancel()
+
+    # a token that lives no longer than the buffers would otherwise be refreshed again straight away, over and over
+    delay = max(TOKEN_REFRESH_MIN_SECS, token_expiration / 2, token_expiration - 2 * expiration_buffer)
+    __token_timer__ = threading.Timer(delay, lambda token: refresh_token(token), args=(__session__.headers.get("Authorization"),))
+    __token_timer__.daemon = True
+    __token_timer__.start()
+    if DEBUG:
+        log.debug(f"Token refresh scheduled in {delay} seconds.")
+
+def build_session():
+    """builds the pooled HTTP session shared by every call to the controller"""
+    global HTTP_STATUS_ERRORS, HTTP_CONNECTION_ERRORS, HTTP_REQUEST_ERRORS, HTTP_TIMEOUT_ERRORS
+    if HTTP2:
+        try:
+            import httpx
+            session = httpx.Client(
+                http2=True,
+                verify=VERIFY_SSL,
+                timeout=None,
+                limits=httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+            )
+        except ImportError:
+            log.warning("HTTP2 is on but httpx[http2] is not installed, falling back to HTTP/1.1.")
+        else:
+            HTTP_STATUS_ERRORS += (httpx.HTTPStatusError,)
+            HTTP_CONNECTION_ERRORS += (httpx.TransportError,)
+            HTTP_REQUEST_ERRORS += (httpx.HTTPError,)
+            HTTP_TIMEOUT_ERRORS += (httpx.TimeoutException,)
+            if DEBUG:
+                log.debug(f"Using an HTTP/2 session with up to {HTTP_POOL_SIZE} connections.")
+            return session
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = VERIFY_SSL
+    if DEBUG:
+        log.debug(f"Using a keep-alive session with up to {HTTP_POOL_SIZE} connections.")
+    return session
+
+def wait_for_rate_limit():
+    """token bucket - blocks until the current request rate allows another request to be sent"""
+    global __rate_tokens__, __rate_updated__
+    if not MAX_REQUESTS_PER_SECOND:
+        return
+
+    with __rate_lock__:
+        now = time.monotonic()
+        # refill for the time that passed, allowing bursts of up to a second's worth of requests
+        __rate_tokens__ = min(max(1.0, __request_rate__), __rate_tokens__ + (now - __rate_updated__) * __request_rate__)
+        __rate_updated__ = now
+        # take a token even if it is not there yet, the wait below covers it and keeps callers in order
+        __rate_tokens__ -= 1
+        wait = -__rate_tokens__ / __request_rate__ if __rate_tokens__ < 0 else 0
+
+    if wait:
+        time.sleep(wait)
+
+def adjust_request_rate(throttled):
+    """halves the request rate when the controller throttles us and creeps back up while it does not"""
+    global __request_rate__
+    if not MAX_REQUESTS_PER_SECOND:
+        return
+
+    with __rate_lock__:
+        if throttled:
+            __request_rate__ = max(0.5, __request_rate__ / 2)
+            log.warning(f"Controller is throttling requests, slowing down to {__request_rate__:.1f} requests/sec.")
+        else:
+            __request_rate__ = min(MAX_REQUESTS_PER_SECOND, __request_rate__ + MAX_REQUESTS_PER_SECOND / 100)
+
+def retry_delay(attempt, response=None):
+    """seconds to wait before a retry - the controller's Retry-After if it sent one, otherwise backoff with jitter"""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            try:
+                return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+
+    return random.uniform(0, min(RETRY_BACKOFF_MAX_SECS, RETRY_BACKOFF_SECS * 2 ** attempt))
+
+def controller_get(url, headers=None, stream=False, timeout=None):
+    """GETs a controller URL over the shared session, the session carries the auth headers. With stream the body is
+    left unread so it can be parsed as it arrives. timeout, in seconds, bounds the wait for each read"""
+    queued = time.perf_counter()
+    ensure_token()
+    wait_for_rate_limit()
+    with __in_flight__:
+        started = time.perf_counter()
+        __request_timing__.waited = started - queued
+        try:
+            if isinstance(__session__, requests.Session):
+                return __session__.get(url, headers=headers, stream=stream, timeout=timeout)
+            if stream:
+                return __session__.send(__session__.build_request("GET", url, headers=headers, timeout=timeout), stream=True)
+            return __session__.get(url, headers=headers, timeout=timeout)
+        finally:
+            # time to the response headers, the body of a streamed response is counted as it is read
+            __request_timing__.seconds = time.perf_counter() - started
+            __request_timing__.streamed = stream
+
+def iter_response_chunks(response, chunk_size=65536):
+    """reads a streamed response body a chunk at a time with whichever HTTP client is in use"""
+    family = endpoint_family(response.url)
+    try:
+        chunks = response.iter_bytes(chunk_size) if hasattr(response, "iter_bytes") else response.iter_content(chunk_size)
+        for chunk in chunks:
+            record_bytes(family, len(chunk))
+            yield chunk
+    finally:
+        response.close()
+
+def iter_json_array(chunks):
+    """yields the items of a top level JSON array one at a time as its bytes arrive, so only the item being parsed is
+    held in memory rather than the whole document"""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    position = 0
+    started = exhausted = False
+
+    while True:
+        # step over the opening bracket and the whitespace and commas between items
+        while position < len(buffer) and buffer[position] in " \t\r\n,[":
+            if buffer[position] == "[":
+                if started:
+                    break
+                started = True
+            position += 1
+
+        if position < len(buffer):
+            if not started:
+                raise json.JSONDecodeError("Expecting a JSON array", buffer, position)
+            if buffer[position] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            else:
+                # only take the item once what follows it has arrived, a number like 45 might really be 45.6
+                if exhausted or (end < len(buffer) and buffer[end] in " \t\r\n,]"):
+                    yield item
+                    position = end
+                    continue
+
+        if exhausted:
+            raise json.JSONDecodeError("Unexpected end of JSON array", buffer, position)
+
+        # need more data - drop what has been parsed already and read the next chunk
+        buffer = buffer[position:]
+        position = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer += utf8.decode(b"", final=True)
+        else:
+            buffer += utf8.decode(chunk)
+
+def iter_xml_elements(chunks, tag):
+    """yields each <tag> element of an XML document as a dict of its children's text as the bytes arrive. Parsed
+    elements are dropped from the tree straight away, so the whole document is never held in memory"""
+    from xml.etree.ElementTree import XMLPullParser
+    parser = XMLPullParser(events=("start", "end"))
+    root = None
+
+    def elements():
+        nonlocal root
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            elif event == "end" and element.tag == tag:
+                yield {child.tag: child.text for child in element}
+                root.clear()
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        yield from elements()
+    parser.close()
+    yield from elements()
+
+def connect(account, apiclient, secret):
+    """Connects to the AppDynamics API and retrieves an OAuth token. The token goes into the headers of the shared
+    session in place, so its pooled connections carry on being used after a refresh."""
+    global last_token_fetch_time, token_expiration
+
+    url = f"{BASE_URL}{OAUTH_PATH}?grant_type=client_credentials&client_id={apiclient}@{account}&client_secret={secret}"
+    payload = {} 
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+    log.info(f"Logging into the controller at: {BASE_URL}")
+
+    @handle_rest_errors  # Apply the error handling decorator
+    def make_auth_request():
+        response = __session__.post(
+            url,
+            headers=headers,
+            data=payload
+        )
+        return response
+
+    auth_response, status = make_auth_request()
+    if DEBUG:
+        log.debug(f"Authentication response:{auth_response} = {status}")
+
+    # Assuming auth_response isn't None if no errors occurred
+    if status == "valid":
+        if auth_response:
+            json_response = auth_response.json()
+    else:
+        log.error(f"Unable to log in at: {BASE_URL}")
+        return False
+
+    __session__.headers['X-CSRF-TOKEN'] = json_response['access_token']
+    __session__.headers['Authorization'] = f'Bearer {json_response["access_token"]}'
+    last_token_fetch_time = time.time()
+    token_expiration = json_response['expires_in']
+    
+    log.info("Authenticated with controller.")
+    
+    if DEBUG:
+        log.debug(f"Last token fetch time: {last_token_fetch_time}")
+        log.debug(f"Token expires in: {json_response['expires_in']}")
+        # the token is a password for as long as it lives, keep it out of the logs
+        headers = {name: "<redacted>" if name.lower() in ("authorization", "x-csrf-token") else value for name, value in __session__.headers.items()}
+        log.debug(f"Session headers: {headers}")
+
+    schedule_token_refresh()
+    
+    return True
+
+def endpoint_family(url):
+    """groups a controller URL with the others of its kind for the request statistics"""
+    path = urllib.parse.urlsplit(str(url)).path
+    for marker, family in ENDPOINT_FAMILIES:
+        if marker in path:
+            return family
+    return "other"
+
+def family_stats(family):
+    """the statistics of an endpoint family, call with __stats_lock__ held"""
+    return __endpoint_stats__.setdefault(family, {"requests": 0, "errors": 0, "bytes": 0, "cache_hits": 0, "waited_secs": 0.0, "latencies": []})
+
+def record_cache_hit(family):
+    """counts a response that came from the on-disk cache instead of the controller"""
+    with __stats_lock__:
+        family_stats(family)["cache_hits"] += 1
+
+def record_request(family, seconds, size, failed, waited=0.0):
+    """adds a request to the statistics of its endpoint family"""
+    with __stats_lock__:
+        stats = family_stats(family)
+        stats["requests"] += 1
+        stats["errors"] += failed
+        stats["bytes"] += size
+        stats["waited_secs"] += waited
+        stats["latencies"].append(seconds)
+
+def record_bytes(family, size):
+    """counts bytes of a streamed response as they are read"""
+    with __stats_lock__:
+        __endpoint_stats__[family]["bytes"] += size
+
+def percentile(ordered, fraction):
+    """nearest rank percentile of an already sorted list"""
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+def request_stats():
+    """a summary of the requests made so far for each endpoint family - count, errors, bytes, time spent waiting for
+    the rate limiter and p50/p95/p99 latency"""
+    summary = {}
+    with __stats_lock__:
+        for family, stats in sorted(__endpoint_stats__.items()):
+            latencies = sorted(stats["latencies"])
+            summary[family] = {
+                "requests": stats["requests"],
+                "errors": stats["errors"],
+                "error_rate": round(stats["errors"] / stats["requests"], 4) if stats["requests"] else 0.0,
+                "bytes": stats["bytes"],
+                "cache_hits": stats["cache_hits"],
+                "waited_secs": round(stats["waited_secs"], 3),
+                "latency_secs_total": round(sum(latencies), 3),
+                "latency_secs_p50": round(percentile(latencies, 0.50), 4),
+                "latency_secs_p95": round(percentile(latencies, 0.95), 4),
+                "latency_secs_p99": round(percentile(latencies, 0.99), 4),
+            }
+    return summary
+
+def print_request_stats():
+    """prints the request statistics table at the end of a run"""
+    summary = request_stats()
+    if not summary:
+        return
+    log.info("Controller requests by endpoint:")
+    log.info(f"    {'endpoint':<24}{'requests':>9}{'errors':>8}{'cached':>8}{'MB':>9}{'waited s':>10}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+    for family, stats in summary.items():
+        log.info(f"    {family:<24}{stats['requests']:>9}{stats['errors']:>8}{stats['cache_hits']:>8}{stats['bytes'] / 1048576:>9.2f}{stats['waited_secs']:>10.1f}"
+              f"{stats['latency_secs_p50'] * 1000:>9.0f}{stats['latency_secs_p95'] * 1000:>9.0f}{stats['latency_secs_p99'] * 1000:>9.0f}")
+
+def write_request_stats(report, json_file=None, prom_file=None):
+    """writes the request statistics as JSON and/or in the Prometheus text format, for the node exporter's textfile
+    collector. Files are replaced in one go so a collector never reads half of one"""
+    summary = request_stats()
+    if json_file:
+        with open(json_file + ".tmp", "w") as output:
+            json.dump({"report": report, "account": APPDYNAMICS_ACCOUNT_NAME, "controller": BASE_URL, "endpoints": summary}, output, indent=2)
+        os.replace(json_file + ".tmp", json_file)
+    if prom_file:
+        metrics = [
+            ("appd_checkup_requests_total", "counter", "Requests sent to the controller.", "requests"),
+            ("appd_checkup_request_errors_total", "counter", "Requests that failed or were throttled.", "errors"),
+            ("appd_checkup_response_bytes_total", "counter", "Bytes received from the controller.", "bytes"),
+            ("appd_checkup_cache_hits_total", "counter", "Responses served from the on-disk cache instead of the controller.", "cache_hits"),
+            ("appd_checkup_rate_limit_wait_seconds_total", "counter", "Time requests waited for the client side rate limiter.", "waited_secs"),
+        ]
+        with open(prom_file + ".tmp", "w") as output:
+            for name, kind, description, key in metrics:
+                output.write(f"# HELP {name} {description}\n# TYPE {name} {kind}\n")
+                for family, stats in summary.items():
+                    output.write(f'{name}{{report="{report}",account="{APPDYNAMICS_ACCOUNT_NAME}",endpoint="{family}"}} {stats[key]}\n')
+            name = "appd_checkup_request_duration_seconds"
+            output.write(f"# HELP {name} Controller response time.\n# TYPE {name} summary\n")
+            for family, stats in summary.items():
+                labels = f'report="{report}",account="{APPDYNAMICS_ACCOUNT_NAME}",endpoint="{family}"'
+                for quantile in ("50", "95", "99"):
+                    output.write(f'{name}{{{labels},quantile="0.{quantile}"}} {stats["latency_secs_p" + quantile]}\n')
+                output.write(f"{name}_sum{{{labels}}} {stats['latency_secs_total']}\n{name}_count{{{labels}}} {stats['requests']}\n")
+        os.replace(prom_file + ".tmp", prom_file)
+
+def setup_logging(level, log_file=None):
+    """sends messages at level and above to the console, and to log_file if given at INFO and above too. DEBUG
+    messages, with the response bodies, are only logged anywhere when level is DEBUG"""
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(logging.Formatter("%(message)s"))
+    console.setLevel(level)
+    log.addHandler(console)
+    if log_file:
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(threadName)s %(message)s"))
+        log.addHandler(file_handler)
+    log.setLevel(min(logging.getLevelName(level), logging.INFO) if log_file else level)
+    log.propagate = False
+
+class Progress:
+    """counts the work done across threads and logs how far along the run is, no more often than every
+    PROGRESS_INTERVAL_SECS seconds. The total can grow as more work is found"""
+    def __init__(self, unit):
+        self.unit = unit
+        self.total = 0
+        self.done = 0
+        self.started = self.logged = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add_total(self, count):
+        with self.lock:
+            self.total += count
+
+    def advance(self, count=1):
+        with self.lock:
+            self.done += count
+            now = time.monotonic()
+            if now - self.logged < PROGRESS_INTERVAL_SECS:
+                return
+            self.logged = now
+            elapsed = now - self.started
+            rate = self.done / elapsed
+            if self.total and self.done < self.total:
+                left = (self.total - self.done) / rate if rate else 0
+                message = f"--- {self.done}/{self.total} {self.unit} ({self.done / self.total:.0%}), {rate:.1f} {self.unit}/s, about {int(left // 60)}:{int(left % 60):02d} left"
+            else:
+                message = f"--- {self.done} {self.unit}, {rate:.1f} {self.unit}/s"
+        log.info(message)
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        log.info(f"--- {self.done} {self.unit} in {elapsed:.1f}s, {self.done / elapsed if elapsed else 0:.1f} {self.unit}/s")
+
+def handle_rest_errors(func):
+    """for handling REST calls - retries throttled and failed requests with backoff"""
+    def inner_function(*args, **kwargs):
+        error_map = {
+            400: "Bad Request - The request was invalid.",
+            401: "Unauthorized - Authentication failed.",
+            403: "Forbidden - You don't have permission to access this resource.",
+            404: "Not Found - The resource could not be found.",
+            429: "Too Many Requests - The controller is throttling requests.",
+            500: "Internal Server Error - Something went wrong on the server.",
+            502: "Bad Gateway - The controller could not be reached through its proxy.",
+            503: "Service Unavailable - The controller is overloaded or down for maintenance.",
+            504: "Gateway Timeout - The controller took too long to respond.",
+        }
+
+        reauthenticated = False
+        for attempt in range(MAX_RETRIES + 1):
+            # requests that do not go through controller_get() (the login) are timed here instead
+            __request_timing__.seconds = None
+            __request_timing__.waited = 0.0
+            __request_timing__.streamed = False
+            __request_timing__.cached = False
+            __request_timing__.revalidated = False
+            started = time.perf_counter()
+            try:
+                response = func(*args, **kwargs)
+                if __request_timing__.cached:
+                    record_cache_hit(endpoint_family(response.url))
+                elif __request_timing__.revalidated:
+                    # the controller only confirmed the cached copy is current, the body came from the cache
+                    record_request(endpoint_family(response.url), __request_timing__.seconds, 0, False, __request_timing__.waited)
+                    record_cache_hit(endpoint_family(response.url))
+                else:
+                    record_request(endpoint_family(response.url), __request_timing__.seconds or time.perf_counter() - started,
+                                   0 if __request_timing__.streamed else len(response.content), response.status_code >= 400, __request_timing__.waited)
+                response.raise_for_status()
+                adjust_request_rate(False)
+                return response, "valid"
+            except HTTP_STATUS_ERRORS as err:
+                error_code = err.response.status_code
+                error_explanation = error_map.get(error_code, "Unknown HTTP Error")
+                if error_code == 401 and not reauthenticated and attempt < MAX_RETRIES and OAUTH_PATH not in str(err.response.url):
+                    # the token was rejected early - refresh it once and go again
+                    reauthenticated = True
+                    log.warning(f"HTTP Error: {error_code} - {error_explanation} Refreshing the token and retrying.")
+                    refresh_token(err.response.request.headers.get("Authorization"))
+                    continue
+                if error_code in RETRYABLE_STATUS_CODES and attempt < MAX_RETRIES:
+                    adjust_request_rate(error_code == 429)
+                    delay = retry_delay(attempt, err.response)
+                    log.warning(f"HTTP Error: {error_code} - {error_explanation} Retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES}).")
+                    time.sleep(delay)
+                    continue
+                log.error(f"HTTP Error: {error_code} - {error_explanation}")
+                return error_explanation, "error"
+            except HTTP_REQUEST_ERRORS as err:
+                try:
+                    url = err.request.url
+                except (AttributeError, RuntimeError):
+                    # no request attached - httpx raises RuntimeError rather than returning None
+                    url = ""
+                record_request(endpoint_family(url), time.perf_counter() - started, 0, True, __request_timing__.waited)
+                if isinstance(err, HTTP_CONNECTION_ERRORS):
+                    if attempt < MAX_RETRIES:
+                        delay = retry_delay(attempt)
+                        log.warning(f"Connection Error: Failed to establish a new connection. Retrying in {delay:.1f}s ({attempt + 1}/{MAX_RETRIES}).")
+                        time.sleep(delay)
+                        continue
+                    log.error("Connection Error: Failed to establish a new connection.")
+                    return err, "error"
+                elif isinstance(err, HTTP_TIMEOUT_ERRORS):
+                    # left to the caller, which may try again with a smaller request
+                    log.warning(f"Request timed out: {err}")
+                    return err, "error"
+                else: 
+                    log.error(f"Request Exception: {err}") 
+                    return err, "error"
+            except Exception:  
+                error_type, error_value, _ = sys.exc_info() 
+                log.error(f"Unexpected Error: {error_type.__name__}: {error_value}")
+                return error_value, "error"
+
+    return inner_function
+
+def validate_json(response):
+    """validation function to parse into JSON and catch empty sets returned from our API requests"""
+    if DEBUG:
+        log.debug("        --- validate_json()")
+    if not response:
+        #this state is NOT always an error. Sometimes there are old tiers with no nodes anymore. Same for apps.
+        if DEBUG:
+            log.debug("        ---- No response object was found.")
+        return [], "empty"
+
+    try:
+        if DEBUG:
+            log.debug(f"        --- validate_json() - incoming response type:: {type(response)}")
+            log.debug(f"        --- validate_json() - incoming response:{response}")
+        if not isinstance(response, requests.Response):
+            if DEBUG:
+                log.debug(f"        --- validate_json() - length: {len(response)}") 
+                log.debug("        --- validate_json() - unpacking response")
+            #unpack response
+            data, data_status = response
+            
+            #pass error and exceptions from the response along to the main code
+            if data_status == "error":
+                return data, data_status
+            else:
+                data = data.json()
+                if DEBUG:
+                    log.debug(f"        --- validate_json() - data: {data} data_status: {data_status}")
+                return data, data_status
+        else:
+            # parse the request object into a json object and its status
+            json_data = response.json()
+
+            if DEBUG:
+                log.debug(f"        --- validate_json() - data: {json_data}")
+                log.debug(f"        --- validate_json() - json_data type: {type(json_data)}")  
+
+            # check for empty JSON object
+            if not json_data:
+                if DEBUG:
+                    log.debug("\n            ---- The resulting JSON object judged as empty")
+                    log.debug(f"            ---- data.text {data.text} , json_data {json_data}")
+                return None, "empty"
+
+            return json_data, "valid"
+
+    except json.JSONDecodeError:
+        # The data is not valid JSON.
+        if DEBUG:
+            log.debug("The data is not valid JSON.")
+        return None, "error"
@@ -0,0 +1,287 @@
+# A stand-in AppDynamics controller for benchmarking and trying out the checkup scripts without a real controller.
+# It serves synthetic applications, tiers, nodes, availability metrics, business transactions, request snapshots, health
+# rules and Server Visibility machines, all generated
+# from the sizes given on the command line, plus the OAuth token endpoint. GET /stats returns how many requests it
+# has served so far. Responses carry an ETag, and a GET that sends it back in If-None-Match gets a 304.
+# usage: python benchmark/mock_controller.py --applications 5 --tiers 10 --nodes 20 --servers 1000 --latency-ms 20
+# then run a script with --base-url http://127.0.0.1:8090
+
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from xml.sax.saxutils import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#--- CONFIGURATION SECTION ---
+# Availability data points are stamped relative to this, the start of the current minute when the controller started
+NOW_MILLIS = int(time.time() // 60 * 60000)
+
+# How long issued tokens live, in seconds
+TOKEN_EXPIRES_SECS = 300
+
+#---FUNCTION DEFINITIONS
+def last_seen(application, tier, node):
+    """when a node last reported, in epoch ms, or None if it never did. Most nodes are up, the rest are spread over
+    the look-back windows the checkup uses so every code path gets exercised"""
+    bucket = (application * 31 + tier * 7 + node) % 10
+    if bucket == 0:
+        return NOW_MILLIS - 40 * 86400000   # 40 days ago
+    if bucket == 1:
+        return None                         # never reported
+    if bucket == 2:
+        return NOW_MILLIS - 3 * 3600000     # 3 hours ago
+    return NOW_MILLIS - 60000               # a minute ago
+
+def node_name(application, tier, node):
+    return f"node-{application}-{tier}-{node}"
+
+def application_json(application):
+    return {"id": application, "name": f"App {application}", "description": f"Synthetic application {application}"}
+
+def tier_json(application, tier, nodes):
+    return {"id": application * 1000 + tier, "name": f"Tier{tier}", "type": "Application Server", "agentType": "APP_AGENT", "numberOfNodes": nodes}
+
+def node_json(application, tier, node):
+    return {
+        "id": (application * 1000 + tier) * 1000 + node,
+        "name": node_name(application, tier, node),
+        "machineName": f"host-{application}-{tier}-{node}",
+        "machineOSType": "Linux",
+        "machineAgentVersion": "",
+        "appAgentVersion": "Server Agent #23.4.0.34799 v23.4.0 GA",
+        "agentType": "APP_AGENT",
+    }
+
+def bt_json(application, bt, tiers):
+    tier = bt % tiers + 1
+    return {"id": application * 100000 + bt, "name": f"/api/v1/resource{bt}", "internalName": f"/api/v1/resource{bt}", "entryPointType": "SERVLET",
+            "tierId": application * 1000 + tier, "tierName": f"Tier{tier}", "background": bt % 10 == 9}
+
+def bts_xml(bts):
+    """the list of business transactions the way the controller sends it without output=json"""
+    elements = "".join("<business-transaction>" + "".join(f"<{key}>{escape(str(value).lower() if isinstance(value, bool) else str(value))}</{key}>" for key, value in bt.items()) + "</business-transaction>" for bt in bts)
+    return f"<business-transactions>{elements}</business-transactions>"
+
+def snapshots_json(application, start_millis, end_millis, maximum_results, sizes):
+    """the first in chain snapshots taken between two times, evenly spaced at snapshots_per_hour"""
+    interval = max(1, 3600000 // sizes.snapshots_per_hour)
+    snapshots = []
+    for taken in range(-(-start_millis // interval) * interval, end_millis, interval):
+        if len(snapshots) >= maximum_results:
+            break
+        index = taken // interval
+        bt = index % sizes.bts + 1
+        tier = bt % sizes.tiers + 1
+        snapshots.append({
+            "requestGUID": f"{application:04x}-{index:012x}", "businessTransactionId": application * 100000 + bt,
+            "applicationComponentId": application * 1000 + tier, "applicationComponentNodeId": (application * 1000 + tier) * 1000 + 1,
+            "serverStartTime": taken, "timeTakenInMilliSecs": 20 + index % 480, "firstInChain": True, "errorOccurred": index % 17 == 0,
+            "userExperience": "ERROR" if index % 17 == 0 else ("SLOW" if index % 480 > 400 else "NORMAL"), "url": f"/api/v1/resource{bt}",
+        })
+    return snapshots
+
+def health_rule_summary(application, rule):
+    return {"id": application * 1000 + rule, "name": f"Health rule {rule}", "enabled": rule % 4 != 0, "affectedEntityType": "BUSINESS_TRANSACTION_PERFORMANCE" if rule % 2 else "TIER_NODE_HEALTH_TRANSACTION_PERFORMANCE"}
+
+def health_rule_json(application, rule):
+    summary = health_rule_summary(application, rule)
+    if rule % 2:
+        affects = {"affectedEntityType": summary["affectedEntityType"], "affectedBusinessTransactions": {"businessTransactionScope": "ALL_BUSINESS_TRANSACTIONS"}}
+    else:
+        affects = {"affectedEntityType": summary["affectedEntityType"], "affectedEntities": {"tierOrNode": "TIER_AFFECTED_ENTITIES", "typeofTier": "SPECIFIC_TIERS", "affectedTiers": ["Tier1", "Tier2"]}}
+    condition = {
+        "name": "Response time", "shortName": "A", "evaluateToTrueOnNoData": False,
+        "evalDetail": {"evalDetailType": "SINGLE_METRIC", "metricAggregateFunction": "VALUE", "metricPath": "Average Response Time (ms)",
+                       "metricEvalDetail": {"metricEvalDetailType": "SPECIFIC_TYPE", "compareCondition": "GREATER_THAN_SPECIFIC_VALUE", "compareValue": 1000 * rule}},
+    }
+    return dict(summary, **{
+        "useDataFromLastNMinutes": 30, "waitTimeAfterViolation": 5, "scheduleName": "Always", "affects": affects,
+        "evalCriterias": {"criticalCriteria": {"conditionAggregationType": "ALL", "conditionExpression": None, "conditions": [condition]}, "warningCriteria": None},
+    })
+
+def server_json(server, sizes):
+    # the pods run the nodes, one each in order, so the nodes can be joined to their servers
+    application, node = divmod(server, sizes.tiers * sizes.nodes)
+    tier, node = divmod(node, sizes.nodes)
+    return {
+        "agentConfig": {"rawConfig": {"_agentRegistrationRequestConfig": {"agentVersion": "4.5.16.0", "machineInfo": "os.name=linux|os.arch=amd64|os.version=unknown"}}},
+        "cpus": [{"cores": 4, "logicalCores": 8, "speedMhz": 2400, "vendor": "GenuineIntel"}],
+        "dynamicMonitoringMode": "KPI",
+        "hierarchy": ["Containers", f"cluster-{server % 7}"],
+        "historical": server % 50 == 0,
+        "hostId": f"{server:012x}",
+        "id": server,
+        "memory": {"Physical": {"sizeMb": 16384}, "Swap": {"sizeMb": 2048}},
+        "name": f"{server:012x}",
+        "properties": {
+            "Container|Created At": "2024-05-20T14:21:39Z",
+            "Container|Image|Name": "registry.example.com/shop/app:1.0",
+            "Container|K8S|Namespace": f"namespace-{server % 13}",
+            "Container|K8S|PodName": f"host-{application + 1}-{tier + 1}-{node + 1}",
+            "Container|Name": "app",
+            "Container|Started At": "2024-05-20T14:21:48Z",
+        },
+        "simEnabled": True,
+        "tags": {"team": [f"team-{server % 5}"]},
+        "type": "CONTAINER",
+        "volumes": [{"mountPoint": "/", "sizeMb": 102400}],
+    }
+
+class Controller(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, without this every response waits out a delayed ACK
+    disable_nagle_algorithm = True
+    sizes = None
+    counts = {"requests": 0, "tokens": 0}
+    counts_lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def count(self, name):
+        with self.counts_lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def send_json(self, body, status=200, content_type="application/json"):
+        body = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if status == 200 and self.command == "GET" and self.headers.get("If-None-Match") == etag:
+            self.count("not modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.count("requests")
+        self.count("tokens")
+        time.sleep(self.sizes.latency_ms / 1000)
+        if urllib.parse.urlsplit(self.path).path != "/controller/api/oauth/access_token":
+            return self.send_json({"error": "not found"}, 404)
+        self.send_json({"access_token": f"token-{self.counts['tokens']}", "expires_in": TOKEN_EXPIRES_SECS})
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        path = [urllib.parse.unquote(part) for part in url.path.strip("/").split("/")]
+        if path == ["stats"]:
+            return self.send_json(self.counts)
+
+        self.count("requests")
+        time.sleep(self.sizes.latency_ms / 1000)
+        if not self.headers.get("Authorization", "").startswith("Bearer "):
+            return self.send_json({"error": "unauthorized"}, 401)
+
+        if path[:3] == ["controller", "rest", "applications"]:
+            return self.rest(path[3:], query)
+        if path[:5] == ["controller", "alerting", "rest", "v1", "applications"] and len(path) > 6 and path[6] == "health-rules":
+            return self.health_rules(int(path[5]), path[7:])
+        if path == ["controller", "sim", "v2", "user", "machines"]:
+            return self.send_machines(query)
+        self.send_json({"error": "not found"}, 404)
+
+    def rest(self, path, query):
+        sizes = self.sizes
+        if not path:
+            return self.send_json([application_json(application) for application in range(1, sizes.applications + 1)])
+        if len(path) == 1:
+            return self.send_json([application_json(int(path[0]))])
+        if len(path) == 2 and path[1] == "tiers":
+            return self.send_json([tier_json(int(path[0]), tier, sizes.nodes) for tier in range(1, sizes.tiers + 1)])
+        if len(path) == 2 and path[1] == "business-transactions":
+            bts = [bt_json(int(path[0]), bt, sizes.tiers) for bt in range(1, sizes.bts + 1)]
+            if query.get("output", [""])[0].lower() == "json":
+                return self.send_json(bts)
+            return self.send_json(bts_xml(bts), content_type="application/xml")
+        if len(path) == 2 and path[1] == "request-snapshots":
+            if query.get("time-range-type", [""])[0] == "BETWEEN_TIMES":
+                start_millis, end_millis = int(query["start-time"][0]), int(query["end-time"][0])
+            else:
+                end_millis = int(time.time() * 1000)
+                start_millis = end_millis - int(query.get("duration-in-mins", ["60"])[0]) * 60000
+            # a wider window keeps a real controller busy for longer
+            time.sleep(sizes.snapshot_latency_ms_per_hour * (end_millis - start_millis) / 3600000 / 1000)
+            return self.send_json(snapshots_json(int(path[0]), start_millis, end_millis, int(query.get("maximum-results", ["1000000"])[0]), sizes))
+        if len(path) == 4 and path[3] == "nodes":
+            application, tier = int(path[0]), int(path[2]) % 1000
+            return self.send_json([node_json(application, tier, node) for node in range(1, sizes.nodes + 1)])
+        if len(path) == 2 and path[1] == "metric-data":
+            return self.send_json(self.metric_data(int(path[0].split()[-1]), query["metric-path"][0], int(query.get("duration-in-mins", ["60"])[0])))
+        self.send_json({"error": "not found"}, 404)
+
+    def health_rules(self, application, path):
+        if not path:
+            return self.send_json([health_rule_summary(application, rule) for rule in range(1, self.sizes.health_rules + 1)])
+        self.send_json(health_rule_json(application, int(path[0]) % 1000))
+
+    def metric_data(self, application, metric_path, duration_mins):
+        """availability for a tier, a node, or every node of one or all tiers when the path has wildcards"""
+        segments = metric_path.split("|")
+        since = NOW_MILLIS - duration_mins * 60000
+        if "Individual Nodes" not in segments:
+            # the tier's app agents reporting in the last minute any of them did
+            tier = int(segments[1].replace("Tier", ""))
+            seen = [last_seen(application, tier, node) for node in range(1, self.sizes.nodes + 1)]
+            seen = [millis for millis in seen if millis is not None and millis >= since]
+            if not seen:
+                return [{"metricName": "METRIC DATA NOT FOUND", "metricPath": metric_path, "metricValues": []}]
+            return [{"metricName": metric_path, "metricPath": metric_path, "metricValues": [{"startTimeInMillis": max(seen), "current": seen.count(max(seen))}]}]
+
+        tier_segment, node_segment = segments[1], segments[3]
+        tiers = range(1, self.sizes.tiers + 1) if tier_segment == "*" else [int(tier_segment.replace("Tier", ""))]
+        metrics = []
+        for tier in tiers:
+            nodes = range(1, self.sizes.nodes + 1) if node_segment == "*" else [int(node_segment.split("-")[-1])]
+            for node in nodes:
+                path = f"Application Infrastructure Performance|Tier{tier}|Individual Nodes|{node_name(application, tier, node)}|Agent|App|Availability"
+                seen = last_seen(application, tier, node)
+                if seen is None or seen < since:
+                    # wildcard queries leave out series without data, single node queries say so
+                    if node_segment != "*":
+                        metrics.append({"metricName": "METRIC DATA NOT FOUND", "metricPath": path, "metricValues": []})
+                    continue
+                metrics.append({"metricName": path, "metricPath": path, "metricValues": [{"startTimeInMillis": seen, "current": 1}]})
+        return metrics
+
+    def send_machines(self, query):
+        """the Server Visibility machine list, paged with offset and limit when they are given"""
+        offset = int(query.get("offset", ["0"])[0])
+        limit = int(query.get("limit", [str(self.sizes.servers)])[0])
+        self.send_json([server_json(server, self.sizes) for server in range(offset, min(offset + limit, self.sizes.servers))])
+
+#--- MAIN
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves a synthetic AppDynamics controller for benchmarks.")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--applications", type=int, default=5)
+    parser.add_argument("--tiers", type=int, default=10, help="tiers per application")
+    parser.add_argument("--nodes", type=int, default=20, help="nodes per tier")
+    parser.add_argument("--bts", type=int, default=20, help="business transactions per application")
+    parser.add_argument("--snapshots-per-hour", type=int, default=600, help="request snapshots per application per hour")
+    parser.add_argument("--snapshot-latency-ms-per-hour", type=float, default=0, help="added to snapshot requests for every hour they cover")
+    parser.add_argument("--health-rules", type=int, default=5, help="health rules per application")
+    parser.add_argument("--servers", type=int, default=1000, help="Server Visibility machines")
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every request")
+    parser.add_argument("--token-expires-secs", type=int, default=TOKEN_EXPIRES_SECS, help="how long issued tokens live (default: %(default)s)")
+    Controller.sizes = parser.parse_args()
+    TOKEN_EXPIRES_SECS = Controller.sizes.token_expires_secs
+
+    server = ThreadingHTTPServer(("127.0.0.1", Controller.sizes.port), Controller)
+    server.daemon_threads = True
+    print(f"Mock controller on http://127.0.0.1:{Controller.sizes.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
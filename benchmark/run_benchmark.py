@@ -0,0 +1,101 @@
+# Runs appd-checkup.py and appd-servers-checkup.py end to end against the mock controller at a few inventory sizes
+# and reports the wall time, the requests each run sent, requests per second and peak memory (RSS).
+# usage: python benchmark/run_benchmark.py [--sizes 1000,10000,100000] [--latency-ms 20] [--scripts checkup,servers]
+# Peak memory comes from os.wait4, so this runs on Linux and macOS.
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+
+#--- CONFIGURATION SECTION ---
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+# each script, with the arguments it is always run with
+SCRIPTS = {
+    "checkup": ["appd-checkup.py", "--no-cache"],
+    "servers": ["appd-servers-checkup.py"],
+}
+
+# inventories are shaped like a typical controller - applications of TIERS_PER_APPLICATION tiers of NODES_PER_TIER
+# nodes each, as many applications as it takes to reach the size. Server Visibility gets one machine per node.
+TIERS_PER_APPLICATION = 10
+NODES_PER_TIER = 20
+
+#---FUNCTION DEFINITIONS
+def controller_stats(base_url):
+    with urllib.request.urlopen(base_url + "/stats") as response:
+        return json.load(response)
+
+def start_controller(port, size, latency_ms):
+    """starts the mock controller for an inventory of size nodes and waits until it answers"""
+    applications = max(1, size // (TIERS_PER_APPLICATION * NODES_PER_TIER))
+    controller = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "mock_controller.py"), "--port", str(port), "--applications", str(applications),
+         "--tiers", str(TIERS_PER_APPLICATION), "--nodes", str(NODES_PER_TIER), "--servers", str(size), "--latency-ms", str(latency_ms)],
+        stdout=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            controller_stats(base_url)
+            return controller, base_url
+        except OSError:
+            time.sleep(0.1)
+    controller.kill()
+    sys.exit(f"The mock controller did not start on port {port}")
+
+def run_script(script, base_url, extra_args, log_file):
+    """runs a script to completion in a scratch directory and measures it"""
+    requests_before = controller_stats(base_url)["requests"]
+    with tempfile.TemporaryDirectory() as scratch, open(log_file, "w") as log:
+        command = [sys.executable, os.path.join(REPO, SCRIPTS[script][0])] + SCRIPTS[script][1:] + [
+            "--base-url", base_url, "--account", "benchmark", "--api-client", "benchmark", "--api-secret", "benchmark"] + extra_args
+        started = time.perf_counter()
+        process = subprocess.Popen(command, cwd=scratch, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_secs = time.perf_counter() - started
+    requests = controller_stats(base_url)["requests"] - requests_before
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return {
+        "wall_secs": round(wall_secs, 2),
+        "requests": requests,
+        "requests_per_sec": round(requests / wall_secs, 1),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "exit_code": os.waitstatus_to_exitcode(status),
+    }
+
+#--- MAIN
+parser = argparse.ArgumentParser(description="Benchmarks the checkup scripts against the mock controller.")
+parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated inventory sizes, in nodes (default: %(default)s)")
+parser.add_argument("--scripts", default=",".join(SCRIPTS), help="comma separated scripts to run (default: %(default)s)")
+parser.add_argument("--latency-ms", type=float, default=0, help="latency the mock controller adds to each request")
+parser.add_argument("--port", type=int, default=8090)
+parser.add_argument("--json", help="also write the results to this file")
+parser.add_argument("--logs", default=".", help="directory for the output of each run (default: the current directory)")
+args, extra_args = parser.parse_known_args()
+# anything else on the command line is passed on to the scripts, e.g. --format parquet
+
+results = []
+print(f"{'script':<10}{'nodes':>8}{'wall s':>10}{'requests':>10}{'req/s':>10}{'peak MB':>10}{'exit':>6}")
+for size in [int(size) for size in args.sizes.split(",")]:
+    controller, base_url = start_controller(args.port, size, args.latency_ms)
+    try:
+        for script in args.scripts.split(","):
+            result = {"script": script, "nodes": size, "latency_ms": args.latency_ms}
+            result.update(run_script(script, base_url, extra_args, os.path.join(args.logs, f"benchmark_{script}_{size}.log")))
+            results.append(result)
+            print(f"{script:<10}{size:>8}{result['wall_secs']:>10}{result['requests']:>10}{result['requests_per_sec']:>10}{result['peak_rss_mb']:>10}{result['exit_code']:>6}", flush=True)
+    finally:
+        controller.terminate()
+        controller.wait()
+
+if args.json:
+    with open(args.json, "w") as output:
+        json.dump(results, output, indent=2)
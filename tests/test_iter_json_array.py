@@ -0,0 +1,68 @@
+import json
+
+import pytest
+
+from appd_core import iter_json_array
+
+
+def chunked(text, size):
+    """the bytes of text in chunks of size, the way a response body arrives"""
+    data = text.encode()
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+
+CHUNK_SIZES = [1, 2, 7]
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("items", [
+    [],
+    [{"id": 1, "name": "App 1"}, {"id": 2, "name": "App 2"}],
+    # numbers are only taken once what follows them has arrived, 45 could still turn into 45.6
+    [45.6, 7, -1200, 3e5, 12345678901234567890],
+    [True, False, None, "text"],
+    # a [ inside an item opens a nested array, not the top level one
+    [[1, [2, 3]], {"tiers": [["a"], []]}, "[", "]"],
+    # multi-byte characters get split across chunks
+    [{"name": "Zürich-Café ☕ 東京 😀"}, "ß"],
+])
+def test_items(items, size):
+    assert list(iter_json_array(chunked(json.dumps(items), size))) == items
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_whitespace(size):
+    text = ' \r\n [ 1 ,\n\t{"a" : [ 2 ] } , 3 ] \n'
+    assert list(iter_json_array(chunked(text, size))) == [1, {"a": [2]}, 3]
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_number_at_the_end(size):
+    # a number the body ends on is taken whole, then the missing ] is reported
+    items = iter_json_array(chunked("[1, 45", size))
+    assert next(items) == 1
+    assert next(items) == 45
+    with pytest.raises(json.JSONDecodeError, match="Unexpected end"):
+        next(items)
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+def test_yields_items_as_they_arrive(size):
+    def arrives():
+        yield from chunked('[{"id": 1}, ', size)
+        raise AssertionError("read past the first item before yielding it")
+    assert next(iter_json_array(arrives())) == {"id": 1}
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", ['{"error": "Not authorized"}', "Internal Server Error", '"[1]"'])
+def test_not_an_array(text, size):
+    with pytest.raises(json.JSONDecodeError, match="Expecting a JSON array"):
+        list(iter_json_array(chunked(text, size)))
+
+
+@pytest.mark.parametrize("size", CHUNK_SIZES)
+@pytest.mark.parametrize("text", ['[{"id": 1}, {"id": 2', '[1, 2', '[1, tru', ""])
+def test_truncated(text, size):
+    with pytest.raises(json.JSONDecodeError):
+        list(iter_json_array(chunked(text, size)))